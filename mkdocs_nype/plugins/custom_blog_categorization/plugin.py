@@ -24,7 +24,7 @@ import posixpath
 from typing import Optional
 
 from material.plugins.blog.plugin import BlogPlugin
-from material.plugins.blog.structure import View
+from material.plugins.blog.structure import Post, View
 from mkdocs.config.defaults import MkDocsConfig
 from mkdocs.exceptions import PluginError
 from mkdocs.plugins import BasePlugin, PrefixedLogger, event_priority
@@ -45,12 +45,14 @@ class CustomBlogCategorizationPlugin(BasePlugin[CustomBlogCategorizationConfig])
 
         self.blog_instance: BlogPlugin = None
         self.custom_view: View = None
+        self.slugs: dict[str, str] = {}
 
     def on_config(self, config):
         """Load the Experience blog instance, override BlogPlugin._render_post"""
 
         self.blog_instance = self._get_exp_blog_instance(config)
         self.custom_view = self.config.view_generator()
+        self.slugs = {}
 
         if self.blog_instance is None:
             LOG.warning("Blog instance with the given exp path was not found")
@@ -207,14 +209,25 @@ class CustomBlogCategorizationPlugin(BasePlugin[CustomBlogCategorizationConfig])
     def _generate_categorization_views(
         self, plugin: BlogPlugin, config: MkDocsConfig, files: Files
     ):
-        """Generate views for custom categorization. Based on BlogPlugin._generate_categories"""
+        """Generate views for custom categorization. Based on BlogPlugin._generate_categories
+
+        The posts are grouped by the view path first, so each view file is resolved only once.
+        """
+
+        allowed_values = set(self.config.allowed_values)
+        paths: dict[str, str] = {}
+        # Names with the same slug share the view, named after the first name
+        names: dict[str, str] = {}
+        posts_by_path: dict[str, list[Post]] = {}
+        paths_by_post: list[tuple[Post, list[str]]] = []
+
         for post in plugin.blog.posts:
+            post_paths = []
+
             for name in post.meta.get(self.config.code_name, []):
-                path = self._format_path_for_industry(plugin, name)
 
                 # Ensure industry is in non-empty allow list
-                allowed_names = self.config.allowed_values or [name]
-                if name not in allowed_names:
+                if allowed_values and name not in allowed_values:
                     docs = os.path.relpath(config.docs_dir)
                     path = os.path.relpath(post.file.abs_src_path, docs)
                     raise PluginError(
@@ -222,30 +235,45 @@ class CustomBlogCategorizationPlugin(BasePlugin[CustomBlogCategorizationConfig])
                         f"'{docs}': name '{name}' not in allow list"
                     )
 
-                # Create file for view, if it does not exist
-                file = files.get_file_from_path(path)
-                if not file or plugin.temp_dir not in file.abs_src_path:
-                    file = plugin._path_to_file(path, config)
-                    files.append(file)
+                path = paths.get(name)
+                if path is None:
+                    path = paths[name] = self._format_path_for_industry(plugin, name)
+                    names.setdefault(path, name)
+
+                posts_by_path.setdefault(path, []).append(post)
+                post_paths.append(path)
+
+            if post_paths:
+                paths_by_post.append((post, post_paths))
+
+        views: dict[str, View] = {}
+
+        for path, posts in posts_by_path.items():
+            name = names[path]
 
-                    # Create file in temporary directory and temporarily remove
-                    # from navigation, as we'll add it at a specific location
-                    plugin._save_to_file(file.abs_src_path, f"# {name}")
-                    file.inclusion = InclusionLevel.EXCLUDED
+            # Create file for view, if it does not exist
+            file = files.get_file_from_path(path)
+            if not file or plugin.temp_dir not in file.abs_src_path:
+                file = plugin._path_to_file(path, config)
+                files.append(file)
 
-                # Create and yield view
-                if not isinstance(file.page, self.custom_view):
-                    yield self.custom_view(name, file, config)
+                # Create file in temporary directory and temporarily remove
+                # from navigation, as we'll add it at a specific location
+                plugin._save_to_file(file.abs_src_path, f"# {name}")
+                file.inclusion = InclusionLevel.EXCLUDED
 
-                # Assign post to industry and vice versa
-                assert isinstance(file.page, self.custom_view)
-                file.page.posts.append(post)
+            # Create and yield view
+            if not isinstance(file.page, self.custom_view):
+                yield self.custom_view(name, file, config)
 
-                # Add custom list for our custom view type
-                if not hasattr(post, self.config.code_name):
-                    setattr(post, self.config.code_name, [])
+            # Assign posts to industry
+            assert isinstance(file.page, self.custom_view)
+            file.page.posts.extend(posts)
+            views[path] = file.page
 
-                getattr(post, self.config.code_name).append(file.page)
+        # Add custom list for our custom view type, and vice versa
+        for post, post_paths in paths_by_post:
+            setattr(post, self.config.code_name, [views[path] for path in post_paths])
 
     def _format_path_for_industry(self, plugin: BlogPlugin, name: str):
         """
@@ -259,9 +287,12 @@ class CustomBlogCategorizationPlugin(BasePlugin[CustomBlogCategorizationConfig])
         return posixpath.join(plugin.config.blog_dir, f"{path}.md")
 
     def _slugify_industry(self, name: str):
-        """Based on BlogPlugin._slugify_category"""
-        separator = self.config.slugify_separator
-        return self.config.slugify(name, separator)
+        """Based on BlogPlugin._slugify_category, memoized until the config reloads"""
+        slug = self.slugs.get(name)
+        if slug is None:
+            separator = self.config.slugify_separator
+            slug = self.slugs[name] = self.config.slugify(name, separator)
+        return slug
 
 
 # endregion
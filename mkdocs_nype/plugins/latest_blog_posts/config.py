@@ -1,5 +1,17 @@
 from mkdocs.config import Config
+from mkdocs.config.config_options import Optional, Type
 
 
 class LatestBlogPostsConfig(Config):
-    pass
+
+    assets_dir = Type(str, default="assets")
+    """Directory in the site_dir for the CSS and JS files, their names contain a content hash"""
+
+    vendor_timeago = Type(bool, default=False)
+    """Serve timeago from the assets_dir, instead of the cdnjs CDN"""
+
+    cache_dir = Type(str, default=".cache/nype/latest_blog_posts")
+    """Cache dir location to store the downloaded timeago"""
+
+    refresh_after_days = Optional(Type(int))
+    """Refresh the `/relative` dates in the browser, when the build is older than this many days"""
@@ -4,19 +4,39 @@ This plugin was formerly a hook:
 
 - https://github.com/nypesap/nypesap.github.io/blob/9951b6669868c657874740c6a124213785441864/overrides/hooks/latest_blog_posts.py
 
-!!! note
-    - Currently limited to the homepage.
+Works on any page, the directive has to start a line in a comment, which can span multiple lines:
+
+    <!-- ext:latest_blog_posts | root=blog; amount=3; title=Latest; read_more=More -->
+
+Directives in code are left as they are, so pages can document them. Indented directives are
+rendered in place, e.g. inside admonitions or list items.
+
+The dates use the `strftime` option, `/timeago` renders them in the browser with timeago, while
+`/relative` formats them at build time with Babel, e.g. "3 days ago", without any library.
+
+The CSS and JS are written once into the assets_dir with a content hash in the names, and the
+pages reference them via `nype_config.head_tags`, which requires the nype theme.
 
 MIT License 2024 Kamil Krzyśków (HRY) for Nype (npe.cm)
 """
 
+import functools
+import hashlib
 import logging
-
+import re
+import textwrap
+from datetime import datetime, timezone
+from pathlib import Path
+from string import Template
+
+import requests  # This is expected to be added by mkdocs-material
+from babel.dates import format_timedelta
 from material.plugins.blog.plugin import BlogPlugin
 from mkdocs.config.defaults import MkDocsConfig
 from mkdocs.exceptions import PluginError
 from mkdocs.plugins import BasePlugin, PrefixedLogger
 from mkdocs.structure.pages import Page
+from mkdocs.utils import get_relative_url, write_file
 from mkdocs_minify_plugin import plugin as minify_plugin
 
 from .config import LatestBlogPostsConfig
@@ -28,11 +48,29 @@ class LatestBlogPostsPlugin(BasePlugin[LatestBlogPostsConfig]):
         super().__init__()
 
         self.exec_count = None
+        self.assets: dict[str, str] = {}
+        self.timeago_path: str = None
+        self.timeago_content: bytes = None
 
     def on_config(self, config: MkDocsConfig):
         BLOG_INSTANCE_MAP.clear()
+        RENDERED_BLOCKS.clear()
+        BLOG_TITLES.clear()
         self.exec_count = {}
 
+        global BUILD_TIME
+        BUILD_TIME = datetime.now(timezone.utc)
+
+        assets_dir = self.config.assets_dir.strip("/")
+        self.assets = get_asset_files(assets_dir)
+        self.timeago_path = None
+
+        # Fail before the build, instead of after all pages already reference the file
+        if self.config.vendor_timeago:
+            cache_dir = Path(config.config_file_path).parent / self.config.cache_dir
+            self.timeago_content = download_timeago(cache_dir)
+            self.timeago_path = f"{assets_dir}/javascripts/{TIMEAGO_FILENAME}"
+
         for name, instance in config.plugins.items():
             instance: BlogPlugin
             if name.split(" ")[0].endswith("/blog"):
@@ -42,46 +80,58 @@ class LatestBlogPostsPlugin(BasePlugin[LatestBlogPostsConfig]):
 
     def on_page_markdown(self, markdown: str, page: Page, config: MkDocsConfig, files):
 
-        if page.file.src_uri != "index.md":
+        # Reject pages without the directive with a single substring check
+        marker = f"ext:{PLUGIN_NAME}"
+        if marker not in markdown:
             return
 
         # awesome-pages-plugin
         if config.nav is None:
             return
 
+        # Links are relative to the docs_dir root, MkDocs resolves them for nested pages
+        root_prefix = "../" * page.file.src_uri.count("/")
+
+        # Date modes of the rendered directives, to only add the scripts they need
+        strftimes: set[str] = set()
+        directives: int = 0
+        code_markers: int = 0
+
+        def replace(match: re.Match) -> str:
+            nonlocal directives, code_markers
+
+            # Code is matched too, to keep the documented directives as they are
+            if match.group("directive") is None or is_indented_code(match.string, match.start()):
+                code_markers += match.group(0).count(marker)
+                return match.group(0)
+
+            directives += 1
+            directive = match.group("directive")
+            block = insert_latest_posts(directive, config, root_prefix, strftimes)
+            if block == directive:
+                return match.group(0)
+
+            # Nested in an admonition or a list item, the whole block keeps the indentation
+            return textwrap.indent(block, match.group("indent"))
+
+        # Find all of the single or multi-line comments in one pass over the text
+        markdown = DIRECTIVE_RE.sub(replace, markdown)
+
+        if not directives:
+            if markdown.count(marker) > code_markers:
+                LOG.warning(
+                    f"Directive in '{page.file.src_uri}' has to start a line in a <!-- --> comment"
+                )
+            return
+
+        # Nothing was rendered, the reasons were already logged
+        if not strftimes:
+            return
+
         self.exec_count[page.file.src_uri] = self.exec_count.get(page.file.src_uri, 0) + 1
 
-        lines = markdown.split("\n")
-
-        ext_body = ""
-        ext_line = -1
-
-        for i, line in enumerate(lines):
-            if f"ext:{PLUGIN_NAME}" in line and ext_line < 0:
-                if "-->" in line:
-                    lines[i] = insert_latest_posts(line, config)
-                else:
-                    # TODO consider parsing this as the start tag, instead of fishing for it
-                    if "<!--" in lines[i - 1]:
-                        lines[i - 1] = ""
-                    ext_body += line
-                    ext_line = i
-                    continue
-            if ext_body:
-                ext_body += " " + line.lstrip()
-                lines[i] = ""
-                if "-->" in line:
-                    lines[ext_line] = insert_latest_posts(ext_body, config)
-                    ext_body = ""
-                    ext_line = -1
-
-        # Add CSS on first exec
+        # Reference the shared assets on first exec, instead of inlining them on each page
         if self.exec_count[page.file.src_uri] == 1:
-            css = f"<style>{minify_plugin.csscompressor.compress(CSS_TEMLATE)}</style>\n"
-            js = f"<script>{minify_plugin.jsmin.jsmin(JS_TEMPLATE)}</script>\n"
-            lines[0] = f"{css}{js}{lines[0]}"
-
-            # Add timeago so that users don't have to
             nype_config = page.meta.get("nype_config")
             if nype_config is None:
                 page.meta["nype_config"] = nype_config = {}
@@ -90,19 +140,136 @@ class LatestBlogPostsPlugin(BasePlugin[LatestBlogPostsConfig]):
             if head_tags is None:
                 nype_config["head_tags"] = head_tags = []
 
-            timeago_tag = {
-                "name": "script",
-                "attributes": {
-                    "src": "https://cdnjs.cloudflare.com/ajax/libs/timeago.js/4.0.2/timeago.min.js",
-                    "defer": "",
-                },
-            }
-            head_tags.append(timeago_tag)
+            use_timeago = any(strftime.startswith("/timeago") for strftime in strftimes)
+            head_tags.extend(self._get_head_tags(page, use_timeago))
+
+            # The refresher is tiny and has to run after the dates, so it's added inline at the end
+            refresh_after_days = self.config.refresh_after_days
+            if refresh_after_days is not None:
+                if any(strftime.startswith("/relative") for strftime in strftimes):
+                    markdown += f"\n<script>{get_relative_refresher(refresh_after_days)}</script>\n"
+
+        return markdown
+
+    def on_post_build(self, *, config: MkDocsConfig) -> None:
+
+        # Only write the assets when any page references them
+        if not self.exec_count:
+            return
+
+        for path, content in self.assets.items():
+            write_file(content.encode("utf-8"), str(Path(config.site_dir) / path))
+
+        if self.timeago_path:
+            write_file(self.timeago_content, str(Path(config.site_dir) / self.timeago_path))
+
+    def _get_head_tags(self, page: Page, use_timeago: bool) -> list[dict[str, dict[str, str]]]:
+        """Tags for the stylesheet and the scripts, timeago has to run before the render script"""
+
+        head_tags = []
+        scripts = []
 
-        return "\n".join(lines)
+        if use_timeago and self.timeago_path:
+            scripts.append(get_relative_url(self.timeago_path, page.url))
+        elif use_timeago:
+            scripts.append(TIMEAGO_URL)
 
+        for path in self.assets:
+            href = get_relative_url(path, page.url)
+            if path.endswith(".css"):
+                head_tags.append(
+                    {"name": "link", "attributes": {"rel": "stylesheet", "href": href}}
+                )
+            elif use_timeago:
+                scripts.append(href)
 
-def insert_latest_posts(line, config: MkDocsConfig):
+        for src in scripts:
+            head_tags.append({"name": "script", "attributes": {"src": src, "defer": ""}})
+
+        return head_tags
+
+
+def insert_latest_posts(
+    line, config: MkDocsConfig, root_prefix: str = "", strftimes: set[str] | None = None
+):
+
+    options = parse_options(line)
+
+    if options is None:
+        return line
+
+    # The same widget is often repeated on many pages, render it once per build
+    key = (root_prefix, *(options[name] for name in RENDER_KEY_OPTIONS))
+
+    if key not in RENDERED_BLOCKS:
+        RENDERED_BLOCKS[key] = render_latest_posts(options, config, root_prefix)
+
+    block = RENDERED_BLOCKS[key]
+
+    if block is None:
+        return line
+
+    if strftimes is not None:
+        strftimes.add(options["strftime"])
+
+    return block
+
+
+def is_indented_code(markdown: str, position: int) -> bool:
+    """Check if the line at the position is in an indented code block. The content of the list
+    items, admonitions and tabs is parsed dedented by 4 spaces, so their code is indented deeper.
+    The code block starts after a blank line, otherwise the line continues the paragraph."""
+
+    containers: list[int] = []
+    fence: str | None = None
+    in_code: bool = False
+    previous_blank: bool = True
+
+    # The position is at the start of a line, scan until the end of that line
+    lines: list[str] = markdown[:position].split("\n")[:-1]
+    lines.append(markdown[position:].split("\n", 1)[0])
+
+    for line in lines:
+        line = line.expandtabs(4)
+        stripped = line.lstrip()
+        indent = len(line) - len(stripped)
+
+        # The fenced code is matched by the DIRECTIVE_RE, its lines only have to be skipped
+        if fence is not None:
+            if stripped.startswith(fence) and not stripped.rstrip().strip(fence[0]):
+                fence = None
+            continue
+
+        if not stripped:
+            previous_blank = True
+            continue
+
+        # Lazy continuation lines of a paragraph stay in the container
+        while (
+            containers
+            and indent < containers[-1]
+            and (previous_blank or CONTAINER_RE.match(stripped))
+        ):
+            containers.pop()
+
+        in_code = indent >= (containers[-1] if containers else 0) + 4 and (
+            previous_blank or in_code
+        )
+        previous_blank = False
+
+        if in_code:
+            continue
+
+        if match := FENCE_RE.match(stripped):
+            fence = match.group(0)
+        elif CONTAINER_RE.match(stripped):
+            containers.append(indent + 4)
+
+    return in_code
+
+
+def parse_options(line) -> dict[str, str] | None:
+    """Parse the options after the last `|` of the directive, None if any is missing"""
 
     raw_options = line.split("|")[-1].replace("-->", "").strip()
     options_pairs = [option.split("=") for option in raw_options.split(";") if option.strip()]
@@ -116,74 +283,80 @@ def insert_latest_posts(line, config: MkDocsConfig):
             all_good = False
 
     if not all_good:
-        return line
+        return None
+
+    options["root"] = options["root"].rstrip("/") + "/"
+    options["display"] = options.get("display", "markdown").lower()
+    options["strftime"] = options.get("strftime") or "/timeago"
+
+    return options
 
-    root = options["root"].rstrip("/") + "/"
+
+def render_latest_posts(options: dict[str, str], config: MkDocsConfig, root_prefix: str):
+    """Render the block for the parsed options, None if it can't be rendered"""
+
+    root = options["root"]
     amount = int(options["amount"])
-    display = options.get("display", "markdown").lower()
+    display = options["display"]
     title = options["title"]
     read_more = options["read_more"]
-    strftime = options.get("strftime")
-    if not strftime:
-        strftime = "/timeago"
+    strftime = options["strftime"]
 
     if display != "markdown":
         LOG.warning("hook -> plugin migration only ported the display=markdown option")
-        return line
+        return None
 
     if root not in BLOG_INSTANCE_MAP:
         LOG.warning(f"Blog root {root} does not match any blog instance")
-        return line
+        return None
 
     instance: BlogPlugin = BLOG_INSTANCE_MAP[root]
     posts = instance.blog.posts[:amount]
 
-    # Hack: extract title from nav, as the blog index file was not loaded yet
-    blog_title = ""
-    for entry in config.nav:
-        for value in entry.values():
-            if not isinstance(value, list):
-                continue
-            if root in value[0]:
-                blog_title = list(entry.keys())[0]
-        if blog_title:
-            break
+    if root not in BLOG_TITLES:
+        BLOG_TITLES[root] = get_blog_title(root, config)
+
+    blog_title = BLOG_TITLES[root]
 
-    li_entries = ""
+    li_entries: list[str] = []
 
     if display == "markdown":
         insert_body = MARKDOWN_GRID_TEMPLATE
-        blog_index_url = instance.blog.file.src_uri
+        blog_index_url = root_prefix + instance.blog.file.src_uri
         for post in posts:
-            href = post.file.src_uri
+            href = root_prefix + post.file.src_uri
             text = post.title
             if strftime.startswith("/timeago"):
                 date = post.config.date["created"]
                 placeholder = post.config.date["created"].strftime("%Y-%m-%d")
                 date_span = f'<span class="nype-latest-post-date" markdown>:material-clock-plus-outline: <span class="timeago" datetime="{date}" locale="en">{placeholder}</span></span>'
+            elif strftime.startswith("/relative"):
+                date = post.config.date["created"]
+                relative = format_relative_date(date, config)
+                date_span = f'<span class="nype-latest-post-date" markdown>:material-clock-plus-outline: <span class="nype-relative-date" datetime="{date.isoformat()}" data-built="{BUILD_TIME.isoformat()}" lang="{config.theme["language"]}">{relative}</span></span>'
             else:
                 date = post.config.date["created"].strftime(strftime)
                 date_span = f'<span class="nype-latest-post-date">{date}</span>'
-            li_entries += f"    - {date_span}\n    [{text}]({href})\n"
-            li_entries += '    {: class="nype-latest-post-entry" }\n'
+            li_entries.append(f"    - {date_span}\n    [{text}]({href})\n")
+            li_entries.append('    {: class="nype-latest-post-entry" }\n')
     elif display == "html_simple":
         insert_body = HTML_SIMPLE_TEMPLATE
         blog_index_url = instance.blog.file.url
         for post in posts:
             href = post.file.url
             text = post.title
-            li_entries += f'<li><a href="{href}">{text}</a></li>\n'
+            li_entries.append(f'<li><a href="{href}">{text}</a></li>\n')
     elif display == "html_grid":
         insert_body = HTML_GRID_TEMPLATE
         blog_index_url = instance.blog.file.url
         for post in posts:
-            li_entries += render_html_grid_li(post, strftime)
+            li_entries.append(render_html_grid_li(post, strftime))
     else:
         raise PluginError(f"display setting not supported: {display}")
 
     return insert_body.format(
         blog_title=blog_title,
-        li_entries=li_entries,
+        li_entries="".join(li_entries),
         blog_index_url=blog_index_url,
         read_more=read_more,
         title=title,
@@ -192,6 +365,77 @@ def insert_latest_posts(line, config: MkDocsConfig):
     )
 
 
+def get_blog_title(root: str, config: MkDocsConfig) -> str:
+    """Hack: extract title from nav, as the blog index file was not loaded yet"""
+
+    for entry in config.nav:
+        for value in entry.values():
+            if not isinstance(value, list):
+                continue
+            if root in value[0]:
+                return list(entry.keys())[0]
+
+    return ""
+
+
+@functools.cache
+def get_asset_files(assets_dir: str) -> dict[str, str]:
+    """Minify the CSS and JS once per process, the content hash in the names allows caching"""
+
+    assets = {}
+
+    for subdir, extension, content in (
+        ("stylesheets", "css", minify_plugin.csscompressor.compress(CSS_TEMLATE)),
+        ("javascripts", "js", minify_plugin.jsmin.jsmin(JS_TEMPLATE)),
+    ):
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:8]
+        assets[f"{assets_dir}/{subdir}/{PLUGIN_NAME}.{digest}.min.{extension}"] = content
+
+    return assets
+
+
+def format_relative_date(date: datetime, config: MkDocsConfig) -> str:
+    """Format the date relative to the build time, e.g. "3 days ago", in the theme language"""
+
+    locale: str = config.theme["language"].replace("-", "_")
+
+    # Post dates without a timezone are local
+    now = BUILD_TIME if date.tzinfo else BUILD_TIME.astimezone().replace(tzinfo=None)
+
+    return format_timedelta(date - now, add_direction=True, locale=locale)
+
+
+@functools.cache
+def get_relative_refresher(refresh_after_days: int) -> str:
+    """Minify the refresher once per process for the given threshold"""
+
+    js = Template(RELATIVE_JS_TEMPLATE).substitute(refresh_after_days=refresh_after_days)
+
+    return minify_plugin.jsmin.jsmin(js)
+
+
+def download_timeago(cache_dir: Path) -> bytes:
+    """Get the pinned timeago version, it's downloaded once into the cache_dir"""
+
+    filepath = cache_dir / TIMEAGO_FILENAME
+
+    if filepath.exists():
+        return filepath.read_bytes()
+
+    try:
+        response = requests.get(TIMEAGO_URL)
+        response.raise_for_status()
+    except Exception as err:
+        raise PluginError(f"Failed to download {TIMEAGO_URL}, disable vendor_timeago\n{err}")
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    filepath.write_bytes(response.content)
+
+    LOG.info(f"Downloaded {filepath}")
+
+    return response.content
+
+
 def render_html_grid_li(post, strftime):
     href = post.file.url
     text = post.title
@@ -221,6 +465,44 @@ LOG: PrefixedLogger = PrefixedLogger(
 BLOG_INSTANCE_MAP: dict[str, BlogPlugin] = {}
 """Mapping of active blog instances. Set in on_config"""
 
+DIRECTIVE_RE: re.Pattern = re.compile(
+    r"^[ \t]*(?P<fence>`{3,}|~{3,}).*?(?:^[ \t]*(?P=fence)[`~]*[ \t]*$|\Z)"
+    r"|`[^`\n]+`"
+    rf"|^(?P<indent>[ \t]*)(?P<directive><!--\s*ext:{PLUGIN_NAME}\b.*?-->)",
+    re.M | re.S,
+)
+"""Directive comment, the options are parsed from the part after the last `|`. Fenced and inline
+code is matched too, to be skipped, the indented code is told apart by is_indented_code"""
+
+FENCE_RE: re.Pattern = re.compile(r"`{3,}|~{3,}")
+"""Opening of a fenced code block, matched at the start of a stripped line"""
+
+CONTAINER_RE: re.Pattern = re.compile(r"(?:[-*+]|\d+[.)])(?:[ \t]|$)|(?:!!!|\?\?\?\+?|===)[ \t]")
+"""List item, admonition, details or content tab, their content is indented by 4 spaces"""
+
+RENDERED_BLOCKS: dict[tuple[str, ...], str | None] = {}
+"""Rendered blocks per root prefix and options, None for blocks that failed. Set per build"""
+
+BLOG_TITLES: dict[str, str] = {}
+"""Blog titles from the nav per blog root. Set per build"""
+
+RENDER_KEY_OPTIONS: list[str] = ["root", "amount", "display", "strftime", "title", "read_more"]
+"""Options that change the rendered block"""
+
+TIMEAGO_VERSION: str = "4.0.2"
+"""Pinned timeago version, loaded from the CDN or vendored into the assets_dir"""
+
+TIMEAGO_URL: str = (
+    f"https://cdnjs.cloudflare.com/ajax/libs/timeago.js/{TIMEAGO_VERSION}/timeago.min.js"
+)
+"""CDN location of timeago"""
+
+TIMEAGO_FILENAME: str = f"timeago-{TIMEAGO_VERSION}.min.js"
+"""Name of the vendored timeago file, versioned to allow caching"""
+
+BUILD_TIME: datetime = None
+"""Reference time for the `/relative` dates. Set per build"""
+
 REQUIRED_OPTIONS: list[str] = ["root", "amount", "title", "read_more"]
 """List of lowercase required options to validate the input"""
 
@@ -310,3 +592,23 @@ document.addEventListener("DOMContentLoaded", () => {
 });
 """.strip()
 )
+
+RELATIVE_JS_TEMPLATE: str = (
+    """
+(() => {
+    "use strict";
+    // Only refresh the build-time relative dates when the build got stale
+    const day = 86400000;
+    const units = [["year", 365], ["month", 30], ["week", 7], ["day", 1]];
+    document.querySelectorAll(".nype-relative-date").forEach((node) => {
+        if (Date.now() - Date.parse(node.dataset.built) < $refresh_after_days * day) {
+            return;
+        }
+        const days = (Date.parse(node.getAttribute("datetime")) - Date.now()) / day;
+        const [unit, size] = units.find(([, size]) => Math.abs(days) >= size) || ["day", 1];
+        const format = new Intl.RelativeTimeFormat(node.lang || undefined, { numeric: "auto" });
+        node.textContent = format.format(Math.round(days / size), unit);
+    });
+})();
+""".strip()
+)
@@ -1,7 +1,7 @@
 from typing import Any
 
 from mkdocs.config import Config
-from mkdocs.config.config_options import Choice, ListOfItems, Optional, Type
+from mkdocs.config.config_options import Choice, DictOfItems, ListOfItems, Optional, Type
 
 
 class SingleValueOrList(Type):
@@ -27,6 +27,12 @@ class SimilarBlogPostsConfig(Config):
     hook_blog_dir = SingleValueOrList(str)
     """A single value or list of matching blog_dir prefixes"""
 
+    cache = Type(bool, default=True)
+    """Enable cache flag"""
+
+    cache_dir = Type(str, default=".cache/nype/similar_blog_posts")
+    """Cache dir location to store the rankings between builds"""
+
     append_at = Choice(("start", "end"), default="end")
     """Where to add the section"""
 
@@ -41,3 +47,22 @@ class SimilarBlogPostsConfig(Config):
 
     max_shown = Type(int, default=5)
     """Limit the number of shown posts"""
+
+    global_index = Type(bool, default=False)
+    """Rank the posts of all hooked blogs together, to link related posts across the blogs"""
+
+    blog_weights = DictOfItems(Type((int, float)), default={})
+    """Score multipliers of the linked posts per blog_dir prefix, used with global_index"""
+
+    similarity_mode = Choice(("categories", "content"), default="categories")
+    """Score by the shared categories, or by the estimated share of common words in the posts"""
+
+    signature_size = Type(int, default=128)
+    """Size of the MinHash signatures in the content mode, larger is more precise but slower"""
+
+    lsh_bands = Optional(Type(int))
+    """Number of LSH bands in the content mode, more bands find less similar candidates,
+    derived from the signature_size and the similarity_threshold by default"""
+
+    max_word_share = Type(float, default=0.5)
+    """Words found in a larger share of the posts are ignored in the content mode, 1 keeps all"""
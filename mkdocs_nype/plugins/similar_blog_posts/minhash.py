@@ -0,0 +1,106 @@
+"""MinHash signatures of the post contents for the similar_blog_posts plugin
+
+Category-only Jaccard ties many posts at the same score, so the content mode compares the sets of
+words of the posts instead. Comparing every pair of posts is quadratic, so each post gets a small
+signature, where the share of equal values estimates the Jaccard similarity of the word sets, and
+the signatures are split into bands for Locality-Sensitive Hashing to only compare the posts that
+share at least one band. Words found in most of the posts are shared by unrelated posts as well,
+so they're dropped before signing to keep the candidates selective.
+
+The signatures use one permutation hashing, each word is hashed once and the hash picks a bin and
+a value, the bin keeps its minimum. Empty bins are filled from the next non-empty bin to keep the
+estimate valid for short posts. This keeps the signing linear in the number of words.
+
+MIT License 2024 Kamil Krzyśków (HRY) for Nype (npe.cm)
+"""
+
+import hashlib
+import re
+from collections import Counter
+
+WORD_RE: re.Pattern = re.compile(r"[^\W\d_]{3,}")
+"""Words of at least 3 letters, shorter words are mostly noise"""
+
+HASH_SPACE: int = 2**64
+"""Range of the word hashes"""
+
+
+def get_words(markdown: str) -> set[str]:
+    """Get the lowercase set of words, Markdown syntax is mostly punctuation and gets skipped"""
+
+    return set(WORD_RE.findall(markdown.lower()))
+
+
+def get_common_words(word_sets: list[set[str]], max_share: float) -> frozenset[str]:
+    """Get the words found in more than max_share of the posts, at least in more than 2 posts,
+    so the few posts of a small blog keep their words"""
+
+    counts: Counter = Counter(word for words in word_sets for word in words)
+    limit: float = max(2, max_share * len(word_sets))
+
+    return frozenset(word for word, count in counts.items() if count > limit)
+
+
+def get_signature(words: set[str], size: int) -> tuple[int, ...]:
+    """Create a one permutation hashing signature of the given size, empty for no words"""
+
+    if not words:
+        return ()
+
+    bins: list[int | None] = [None] * size
+    bin_range: int = HASH_SPACE // size + 1
+
+    for word in words:
+        value = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "big")
+        index, value = divmod(value, bin_range)
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+
+    # Densify by rotation, the offset keeps the borrowed values apart from the real ones
+    for index in range(size):
+        distance = 1
+        while bins[index] is None:
+            borrowed = bins[(index + distance) % size]
+            if borrowed is not None and borrowed < bin_range:
+                bins[index] = borrowed + distance * bin_range
+            distance += 1
+
+    return tuple(bins)
+
+
+def get_band_count(size: int, threshold: float) -> int:
+    """Pick the most rows per band, while the similarity at which the posts become likely
+    candidates, roughly (1/bands)^(1/rows), stays at or below the threshold. Fewer rows make
+    the dissimilar posts candidates too, more rows start to miss the similar ones."""
+
+    bands: int = size
+    for rows in range(2, size + 1):
+        if (1 / (size // rows)) ** (1 / rows) > threshold:
+            break
+        bands = size // rows
+
+    return bands
+
+
+def get_band_keys(signature: tuple[int, ...], bands: int) -> list[int]:
+    """Split the signature into bands, posts sharing any band key are compared. The values left
+    over by the division are skipped, a shorter band would match too easily."""
+
+    if not signature:
+        return []
+
+    rows = max(1, len(signature) // bands)
+    return [
+        hash((start, signature[start : start + rows]))
+        for start in range(0, rows * min(bands, len(signature)), rows)
+    ]
+
+
+def estimate_similarity(signature_a: tuple[int, ...], signature_b: tuple[int, ...]) -> float:
+    """Share of the equal values estimates the Jaccard similarity of the word sets"""
+
+    if not signature_a or not signature_b:
+        return 0
+
+    matches = sum(1 for a, b in zip(signature_a, signature_b) if a == b)
+    return matches / len(signature_a)
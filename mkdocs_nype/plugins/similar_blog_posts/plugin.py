@@ -18,8 +18,15 @@ Can be seen in use here:
 MIT License 2024 Kamil Krzyśków (HRY) for Nype (npe.cm) and Fiori Tracker (fioritracker.org)
 """
 
+import hashlib
+import heapq
+import json
 import logging
+import os
 import random
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from operator import itemgetter
 from pathlib import Path
 
 from material.plugins.blog.plugin import BlogPlugin
@@ -30,6 +37,14 @@ from mkdocs.structure.files import Files
 from mkdocs.structure.pages import Page
 
 from .config import SimilarBlogPostsConfig
+from .minhash import (
+    estimate_similarity,
+    get_band_count,
+    get_band_keys,
+    get_common_words,
+    get_signature,
+    get_words,
+)
 
 
 class SimilarBlogPostsPlugin(BasePlugin[SimilarBlogPostsConfig]):
@@ -38,12 +53,26 @@ class SimilarBlogPostsPlugin(BasePlugin[SimilarBlogPostsConfig]):
 
         self.blog_instance_map: dict[str, BlogPlugin] = {}
         self.sanitized_prefixes: list[str] = []
+        self.blog_weights: dict[str, float] = {}
+        self.category_index: dict[str, CategoryIndex] = {}
+        self.lsh_bands: int = None
+        self.signatures: dict[str, tuple[int, ...]] = {}
+        self.used_signatures: set[str] = set()
+        self.cache_path: Path = None
+        self.cache_data: dict = None
+        self.cache_changed: bool = False
+
+    def on_startup(self, *, command, dirty):
+        """MkDocs keeps the plugins defining this event between the serve rebuilds, which keeps
+        the loaded cache and the signatures of the unchanged posts"""
 
     def on_config(self, config: MkDocsConfig) -> MkDocsConfig | None:
         """Sanitize prefixes and load blog instances"""
 
         self.blog_instance_map.clear()
         self.sanitized_prefixes.clear()
+        self.category_index.clear()
+        self.used_signatures.clear()
 
         # The config value can be a str, convert it to a list
         if isinstance(self.config.hook_blog_dir, str):
@@ -51,6 +80,11 @@ class SimilarBlogPostsPlugin(BasePlugin[SimilarBlogPostsConfig]):
 
         # Prepare prefixes for synced validation
         self.sanitized_prefixes = [p.rstrip("/") + "/" for p in self.config.hook_blog_dir]
+        self.blog_weights = {p.rstrip("/") + "/": w for p, w in self.config.blog_weights.items()}
+
+        for prefix in self.blog_weights:
+            if prefix not in self.sanitized_prefixes:
+                LOG.warning(f"Weighted prefix '{prefix}' is not in hook_blog_dir")
 
         # Load instances that have matching prefixes
         for name, instance in config.plugins.items():
@@ -68,6 +102,28 @@ class SimilarBlogPostsPlugin(BasePlugin[SimilarBlogPostsConfig]):
         if self.blog_instance_map:
             LOG.info("Found matching blog instances")
 
+        # A band count that doesn't fit the threshold compares nearly every pair of posts
+        self.lsh_bands = self.config.lsh_bands or get_band_count(
+            self.config.signature_size, self.config.similarity_threshold
+        )
+
+        # Configure cache
+        cache_path = Path(config.config_file_path).parent / self.config.cache_dir / "cache.json"
+        if cache_path != self.cache_path:
+            self.cache_path = cache_path
+            self.cache_data = None
+
+    def on_post_build(self, *, config: MkDocsConfig) -> None:
+        """Drop the signatures of removed or changed posts, they're kept between serve rebuilds"""
+
+        for key in self.signatures.keys() - self.used_signatures:
+            del self.signatures[key]
+            self.cache_changed = True
+
+        if self.config.cache and self.cache_changed:
+            self._save_cache()
+            self.cache_changed = False
+
     def on_page_markdown(
         self, markdown: str, /, *, page: Page, config: MkDocsConfig, files: Files
     ) -> str | None:
@@ -86,47 +142,33 @@ class SimilarBlogPostsPlugin(BasePlugin[SimilarBlogPostsConfig]):
         else:
             return
 
-        set_a = set(categories_self)
-        similar_posts: list[Page, float] = []
-        other_posts: list[Page, float] = []
-        processed_post_ids = set()  # Track duplicates between categories
-
-        # Find similar posts
-        for view in blog_instance.blog.views:
-            # Skip non-category views
-            if not isinstance(view, Category):
-                continue
-
-            # Skip categories not related to current post
-            if not self.config.allow_other_categories and view.name not in set_a:
-                continue
-
-            for post in view.posts:
-                # Skip self and processed
-                if post is page or id(post) in processed_post_ids:
-                    continue
+        # The global index is shared by all of the blogs and built once
+        if self.config.global_index:
+            key, blogs = GLOBAL_INDEX_KEY, self.blog_instance_map
+        else:
+            key, blogs = prefix, {prefix: blog_instance}
 
-                categories_other = post.meta.get("categories")
-                set_b = set(categories_other)
-                score = self.weighted_jaccard_similarity(set_a, set_b)
+        index = self.category_index.get(key)
+        if index is None:
+            index = self.category_index[key] = self._build_index(key, blogs)
 
-                if score >= self.config.similarity_threshold:
-                    similar_posts.append((post, score))
-                elif self.config.allow_other_categories:
-                    other_posts.append((post, score))
+        set_a = frozenset(categories_self)
 
-                processed_post_ids.add(id(post))
+        similar_posts, other_count = self._get_ranking(page, set_a, index)
 
         # Early return if no similar posts were found
-        if not similar_posts and not other_posts:
+        if not similar_posts and (not self.config.allow_other_categories or not other_count):
             return
 
-        # Sort posts based on score from highest to lowest
-        similar_posts = sorted(similar_posts, key=lambda p: -p[1])
-
-        # Limit the result to max_shown
-        if self.config.max_shown > 0 and len(similar_posts) > self.config.max_shown:
-            similar_posts = similar_posts[: self.config.max_shown]
+        # The rest of the posts in the order of the views, only needed to pad the list
+        other_posts: list[Page, float] = []
+        if self.config.allow_other_categories and len(similar_posts) < self.config.max_shown:
+            similar_ids = {id(post) for post, _ in similar_posts}
+            other_posts = [
+                (post, 0)
+                for post in index.posts
+                if post is not page and id(post) not in similar_ids
+            ]
 
         # Randomize other_posts a bit to avoid padding all the posts with the same other_posts
         # Use seed to have somewhat constant results across different rebuilds, but also keep it unique to the post
@@ -142,14 +184,14 @@ class SimilarBlogPostsPlugin(BasePlugin[SimilarBlogPostsConfig]):
             similar_posts.append(other_posts.pop())
 
         posts_md = ""
-        current_path = Path(page.file.abs_src_path).parent
+
+        # Link to the src_uri from the docs_dir root, MkDocs resolves it to the final URL
+        root_prefix = "../" * page.file.src_uri.count("/")
 
         for post, score in similar_posts:
 
             url_title = post.title
-            url_path = (
-                Path(post.file.abs_src_path).relative_to(current_path, walk_up=True).as_posix()
-            )
+            url_path = root_prefix + post.file.src_uri
 
             posts_md += f"- [{url_title}]({url_path})\n"
 
@@ -166,31 +208,433 @@ class SimilarBlogPostsPlugin(BasePlugin[SimilarBlogPostsConfig]):
 
         return markdown
 
+    def _get_ranking(
+        self, page: Page, set_a: frozenset[str], index: "CategoryIndex"
+    ) -> tuple[list[tuple[Page, float]], int]:
+        """Get the precomputed ranking, pages outside of the index are ranked separately,
+        like posts with categories changed by other plugins"""
+
+        if id(page) in index.rankings and index.categories[id(page)] == set_a:
+            ranking = index.rankings[id(page)]
+        else:
+            ranking = self._rank(page, set_a, index)
+
+        # Copy, as the list is extended with the other posts
+        return list(ranking[0]), ranking[1]
+
+    def _rank(
+        self, page: Page, set_a: frozenset[str], index: "CategoryIndex"
+    ) -> tuple[list[tuple[Page, float]], int]:
+        """Get the top max_shown similar posts sorted by score and the number of the other posts"""
+
+        threshold: float = self.config.similarity_threshold
+        allow_other: bool = self.config.allow_other_categories
+
+        if self.config.similarity_mode == "content":
+            rows = self._score_content(page, set_a, index)
+        else:
+            rows = self._score_categories(set_a, index)
+
+        # With allow_other_categories the ties keep the order of the views,
+        # otherwise the order of the matching categories
+        similar: list[tuple[float, int, Page]] = []
+        for order, (position, score) in enumerate(rows):
+            post = index.posts[position]
+            if post is page:
+                continue
+
+            # Only set for the global_index with blog_weights
+            weight = index.weights.get(id(post))
+            if weight is not None:
+                score *= weight
+
+            if score >= threshold:
+                similar.append((-score, position if allow_other else order, post))
+
+        other_count: int = len(index.posts) - len(similar) - (id(page) in index.positions)
+
+        # Sort posts based on score from highest to lowest, limit the result to max_shown
+        if self.config.max_shown > 0:
+            similar = heapq.nsmallest(self.config.max_shown, similar, key=itemgetter(0, 1))
+        else:
+            similar.sort(key=itemgetter(0, 1))
+
+        return [(post, -score) for score, _, post in similar], other_count
+
+    def _score_categories(
+        self, set_a: frozenset[str], index: "CategoryIndex"
+    ) -> Iterator[tuple[int, float]]:
+        """The intersection counts come from the inverted index, which equals a sparse row of the
+        post x post product of the incidence matrix, so the sets are never intersected"""
+
+        # Keyed by the position in index.posts, in the order of the category views
+        counts: dict[int, int] = {}
+        for name, posts in index.category_posts.items():
+            if name in set_a:
+                for post in posts:
+                    position = index.positions[id(post)]
+                    counts[position] = counts.get(position, 0) + 1
+
+        # Only the posts sharing a category can reach a positive score
+        if self.config.allow_other_categories and self.config.similarity_threshold <= 0:
+            rows = ((position, counts.get(position, 0)) for position in range(len(index.posts)))
+        else:
+            rows = counts.items()
+
+        for position, count in rows:
+            size_b = len(index.categories[id(index.posts[position])])
+            yield position, weighted_jaccard_score(count, len(set_a), size_b)
+
+    def _score_content(
+        self, page: Page, set_a: frozenset[str], index: "CategoryIndex"
+    ) -> Iterator[tuple[int, float]]:
+        """Only the posts sharing a LSH band with the page are compared, and without
+        allow_other_categories also a category, like in the categories mode"""
+
+        signature = index.signatures.get(id(page))
+        if signature is None:
+            words = get_words(page.markdown) - index.common_words
+            signature = get_signature(words, self.config.signature_size)
+
+        if self.config.allow_other_categories and self.config.similarity_threshold <= 0:
+            positions = range(len(index.posts))
+        else:
+            positions = set()
+            for key in get_band_keys(signature, self.lsh_bands):
+                positions.update(index.buckets.get(key, ()))
+            positions = sorted(positions)
+
+        for position in positions:
+            post = index.posts[position]
+            if not self.config.allow_other_categories and set_a.isdisjoint(
+                index.categories[id(post)]
+            ):
+                continue
+
+            yield position, estimate_similarity(signature, index.signatures[id(post)])
+
+    def _build_index(self, key: str, blogs: dict[str, BlogPlugin]) -> "CategoryIndex":
+        """Build the index and rank all of the posts once per build, the blog plugin populates
+        the views in on_files"""
+
+        self._load_cache()
+
+        index = build_category_index(blogs)
+
+        if self.config.global_index and self.blog_weights:
+            for post in index.posts:
+                blog = index.blogs[id(post)]
+                if blog in self.blog_weights:
+                    index.weights[id(post)] = self.blog_weights[blog]
+
+        if self.config.similarity_mode == "content":
+            self._sign_posts(index)
+
+        index.rankings = self._rank_all(key, index)
+
+        return index
+
+    def _sign_posts(self, index: "CategoryIndex"):
+
+        signed: int = 0
+        size: int = self.config.signature_size
+
+        # The posts are read by the blog plugin in on_files, so the Markdown is still unchanged
+        words: list[set[str]] = [get_words(post.markdown) for post in index.posts]
+        index.common_words = get_common_words(words, self.config.max_word_share)
+        common_key: str = hashlib.sha256(" ".join(sorted(index.common_words)).encode()).hexdigest()
+
+        # Signatures are kept by content hash, so serve rebuilds only sign the changed posts.
+        # A change of the common words invalidates all of them.
+        for position, post in enumerate(index.posts):
+            key = hashlib.sha256(f"{size}:{common_key}:{post.markdown}".encode()).hexdigest()
+            signature = self.signatures.get(key)
+            if signature is None:
+                signature = get_signature(words[position] - index.common_words, size)
+                self.signatures[key] = signature
+                signed += 1
+
+            self.used_signatures.add(key)
+            index.content_keys[id(post)] = key
+            index.signatures[id(post)] = signature
+            for band_key in get_band_keys(signature, self.lsh_bands):
+                index.buckets.setdefault(band_key, []).append(position)
+
+        LOG.debug(f"Signed {signed} of {len(index.posts)} posts")
+
+    def _rank_all(self, prefix: str, index: "CategoryIndex") -> dict[int, tuple[list, int]]:
+        """Rank all of the posts, reusing the cached rankings of the posts that weren't affected
+        by the changes since the previous build"""
+
+        settings: str = json.dumps(
+            [
+                self.config.similarity_mode,
+                self.config.similarity_threshold,
+                self.config.allow_other_categories,
+                self.config.max_shown,
+                self.config.signature_size,
+                self.lsh_bands,
+                self.config.max_word_share,
+                self.config.global_index and self.blog_weights,
+            ]
+        )
+
+        # The ranking only depends on the settings and these values, in the order of the index
+        keys: dict[str, list] = {
+            post.file.src_uri: [
+                sorted(index.categories[id(post)]),
+                str(post.meta.get("date")),
+                index.content_keys.get(id(post)),
+            ]
+            for post in index.posts
+        }
+        fingerprint: str = hashlib.sha256(
+            json.dumps([settings, *keys.items()]).encode()
+        ).hexdigest()
+
+        cached: dict = self.cache_data["blogs"].get(prefix) if self.config.cache else None
+
+        if cached and cached["fingerprint"] == fingerprint:
+            affected = set()
+        elif cached and cached["settings"] == settings:
+            affected = self._get_affected(index, keys, cached)
+        else:
+            affected = set(keys)
+
+        rankings: dict[int, tuple[list, int]] = {}
+        cached_posts: dict = cached["posts"] if cached else {}
+        posts: dict[str, dict] = {}
+        post_map: dict[str, Page] = {post.file.src_uri: post for post in index.posts}
+
+        for post in index.posts:
+            src_uri: str = post.file.src_uri
+
+            # Posts referencing removed posts are normally affected anyway, but stay safe
+            cached_post: dict = cached_posts.get(src_uri)
+            if cached_post and any(uri not in post_map for uri, _ in cached_post["ranked"]):
+                affected.add(src_uri)
+
+            if src_uri in affected:
+                similar_posts, other_count = self._rank(post, index.categories[id(post)], index)
+                similar_count = len(index.posts) - 1 - other_count
+                ranked = [[other.file.src_uri, score] for other, score in similar_posts]
+            else:
+                similar_count = cached_post["similar_count"]
+                ranked = cached_post["ranked"]
+                similar_posts = [(post_map[uri], score) for uri, score in ranked]
+                other_count = len(index.posts) - 1 - similar_count
+
+            rankings[id(post)] = (similar_posts, other_count)
+            posts[src_uri] = {
+                "key": keys[src_uri],
+                "ranked": ranked,
+                "similar_count": similar_count,
+            }
+
+        LOG.debug(f"Ranked {len(affected)} of {len(index.posts)} posts in '{prefix}'")
+
+        if self.config.cache and fingerprint != (cached or {}).get("fingerprint"):
+            self.cache_data["blogs"][prefix] = {
+                "fingerprint": fingerprint,
+                "settings": settings,
+                "posts": posts,
+            }
+            self.cache_changed = True
+
+        return rankings
+
+    def _get_affected(
+        self, index: "CategoryIndex", keys: dict[str, list], cached: dict
+    ) -> set[str]:
+        """Get the posts that changed, and the posts which could rank them differently"""
+
+        cached_posts: dict[str, dict] = cached["posts"]
+
+        changed: set[str] = {
+            uri for uri in keys if cached_posts.get(uri, {}).get("key") != keys[uri]
+        }
+        changed.update(cached_posts.keys() - keys.keys())
+
+        if not changed:
+            return changed
+
+        # All of the posts are candidates for each other
+        if self.config.allow_other_categories and self.config.similarity_threshold <= 0:
+            return set(keys)
+
+        affected: set[str] = changed & keys.keys()
+
+        for uri in changed:
+            old_key = cached_posts.get(uri, {}).get("key")
+            new_key = keys.get(uri)
+
+            # Posts sharing the old or the new categories of the changed post
+            names: set[str] = set()
+            for key in (old_key, new_key):
+                if key is not None:
+                    names.update(key[0])
+
+            for name in names:
+                affected.update(post.file.src_uri for post in index.category_posts.get(name, ()))
+
+            if self.config.similarity_mode != "content":
+                continue
+
+            # Posts sharing a LSH band with the old or the new signature of the changed post
+            for key in (old_key, new_key):
+                signature = self.signatures.get(key[2]) if key is not None else None
+                if not signature:
+                    continue
+                for band_key in get_band_keys(signature, self.lsh_bands):
+                    affected.update(
+                        index.posts[position].file.src_uri
+                        for position in index.buckets.get(band_key, ())
+                    )
+
+        return affected
+
+    def _load_cache(self):
+        """Load the rankings and signatures of the previous build, once per serve session"""
+
+        if self.cache_data is not None:
+            return
+
+        self.cache_data = {"blogs": {}, "signatures": {}}
+
+        if not self.config.cache or not self.cache_path.exists():
+            return
+
+        try:
+            with open(self.cache_path, encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as error:
+            LOG.warning(f"Ignoring the unreadable cache '{self.cache_path}': {error}")
+            return
+
+        if data.get("version") != CACHE_VERSION:
+            return
+
+        self.cache_data["blogs"] = data["blogs"]
+        for key, signature in data["signatures"].items():
+            self.signatures.setdefault(key, tuple(signature))
+
+    def _save_cache(self):
+        """Write the cache atomically, an interrupted build keeps the previous file"""
+
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+        data = {
+            "version": CACHE_VERSION,
+            "blogs": self.cache_data["blogs"],
+            "signatures": {key: self.signatures[key] for key in self.used_signatures},
+        }
+
+        temp_path = self.cache_path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file, separators=(",", ":"))
+        os.replace(temp_path, self.cache_path)
+
     def weighted_jaccard_similarity(
         self, set_a: set[str], set_b: set[str], use_weights: bool = True
     ) -> float:
         """Jaccard Similarity method was suggested by ChatGPT. Currently only weighted variant is being used"""
 
-        # Sanity check
-        if not set_a or not set_b:
-            return 0
+        return weighted_jaccard_score(
+            len(set_a.intersection(set_b)), len(set_a), len(set_b), use_weights
+        )
 
-        # Calculate the top part of the equation
-        numerator = len(set_a.intersection(set_b))
 
-        if numerator == 0:
-            return 0
+def weighted_jaccard_score(
+    intersection: int, size_a: int, size_b: int, use_weights: bool = True
+) -> float:
+    """Jaccard Similarity from the set sizes, to allow counting the intersections in bulk"""
 
-        # Use weights to handle small vs big sets a bit better
-        if use_weights:
-            weight_a = len(set_b) / (len(set_a) + len(set_b))
-            weight_b = len(set_a) / (len(set_a) + len(set_b))
-            denominator = (weight_a * len(set_a)) + (weight_b * len(set_b))
-        else:
-            # Calculate the bottom part of the equation
-            denominator = len(set_a.union(set_b))
+    # Sanity check
+    if not size_a or not size_b:
+        return 0
+
+    # Calculate the top part of the equation
+    numerator = intersection
+
+    if numerator == 0:
+        return 0
+
+    # Use weights to handle small vs big sets a bit better
+    if use_weights:
+        weight_a = size_b / (size_a + size_b)
+        weight_b = size_a / (size_a + size_b)
+        denominator = (weight_a * size_a) + (weight_b * size_b)
+    else:
+        # Calculate the bottom part of the equation
+        denominator = size_a + size_b - intersection
+
+    return numerator / denominator
+
+
+@dataclass
+class CategoryIndex:
+    """Inverted index of the category views of a blog instance"""
+
+    posts: list[Page]
+    """Posts in the order of their first occurrence in the category views"""
+
+    positions: dict[int, int]
+    """Position of each post in `posts`, keyed by id(post)"""
 
-        return numerator / denominator
+    categories: dict[int, frozenset[str]]
+    """Categories of each post, keyed by id(post)"""
+
+    category_posts: dict[str, list[Page]]
+    """Posts of each category, in the order of the views"""
+
+    rankings: dict[int, tuple[list[tuple[Page, float]], int]] | None = None
+    """Ranked similar posts and the number of other posts, keyed by id(post)"""
+
+    blogs: dict[int, str] = field(default_factory=dict)
+    """Blog prefix of each post, keyed by id(post)"""
+
+    weights: dict[int, float] = field(default_factory=dict)
+    """Score multipliers of the posts from the blog_weights, keyed by id(post)"""
+
+    content_keys: dict[int, str] = field(default_factory=dict)
+    """Content hashes of the posts in the content mode, keyed by id(post)"""
+
+    signatures: dict[int, tuple[int, ...]] = field(default_factory=dict)
+    """MinHash signatures of the posts in the content mode, keyed by id(post)"""
+
+    buckets: dict[int, list[int]] = field(default_factory=dict)
+    """Positions of the posts sharing a LSH band key in the content mode"""
+
+    common_words: frozenset[str] = frozenset()
+    """Words left out of the signatures in the content mode, as most of the posts contain them"""
+
+
+def build_category_index(blogs: dict[str, BlogPlugin]) -> CategoryIndex:
+    """Scan the category views of the blog instances, categories with the same name are merged"""
+
+    index = CategoryIndex([], {}, {}, {})
+
+    for prefix, blog_instance in blogs.items():
+        for view in blog_instance.blog.views:
+            # Skip non-category views
+            if not isinstance(view, Category):
+                continue
+
+            if view.name in index.category_posts:
+                index.category_posts[view.name] = index.category_posts[view.name] + view.posts
+            else:
+                index.category_posts[view.name] = view.posts
+
+            for post in view.posts:
+                if id(post) in index.positions:
+                    continue
+
+                index.positions[id(post)] = len(index.posts)
+                index.posts.append(post)
+                index.categories[id(post)] = frozenset(post.meta.get("categories"))
+                index.blogs[id(post)] = prefix
+
+    return index
 
 
 # region Constants
@@ -203,6 +647,12 @@ LOG: PrefixedLogger = PrefixedLogger(
 )
 """Logger instance for this plugins."""
 
+GLOBAL_INDEX_KEY: str = "*"
+"""Key of the index shared by all blogs with global_index enabled"""
+
+CACHE_VERSION: int = 1
+"""Version of the cache file format, other versions are ignored"""
+
 SECTION_TEMPLATE: str = (
     """
 <div class="nype-similar" markdown>
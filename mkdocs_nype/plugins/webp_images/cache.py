@@ -0,0 +1,192 @@
+"""SQLite backed cache index for the webp_images plugin
+
+The index used to be a pretty-printed `index.json` dumped as a whole after each build, which was
+lost or half-written when a build got interrupted, and parallel CI jobs sharing the cache raced
+on it. SQLite provides atomic transactions, file locking and cheap partial writes out of the box.
+
+The blob store can be shared between projects, so the entries are namespaced per project, while
+the blob references are checked across all of the namespaces before removing a blob. The dropped
+blobs are kept in a garbage table until they weren't used for a grace period, as parallel builds
+could be linking them right now. Namespaces that weren't built for a long time expire, so their
+entries stop pinning the blobs.
+
+MIT License 2024 Kamil Krzyśków (HRY) for Nype (npe.cm)
+"""
+
+import json
+import sqlite3
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class CacheIndex:
+    """Store the cache index entries as compact JSON rows, with the blob references split out"""
+
+    def __init__(self, path: Path, namespace: str, timeout: float = 60) -> None:
+        self.path: Path = path
+        """Location of the SQLite database file"""
+
+        self.namespace: str = namespace
+        """Project key, to allow sharing the cache between projects"""
+
+        self.timeout: float = timeout
+        """Seconds to wait for the lock of another process"""
+
+    def load(self) -> dict[str, dict]:
+        """Load all entries of the namespace"""
+
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT name, entry FROM entries WHERE namespace = ?", (self.namespace,)
+            )
+            return {name: json.loads(entry) for name, entry in rows}
+
+    def save(self, updated: dict[str, dict], removed: Iterable[str]):
+        """Write the changed entries in a single transaction and mark the namespace as used"""
+
+        removed = [(self.namespace, name) for name in removed]
+        replaced = [(self.namespace, name) for name in updated]
+
+        with self._transaction() as connection:
+            connection.executemany(
+                "DELETE FROM entries WHERE namespace = ? AND name = ?", removed + replaced
+            )
+            connection.executemany(
+                "DELETE FROM blobs WHERE namespace = ? AND name = ?", removed + replaced
+            )
+            connection.executemany(
+                "INSERT INTO entries (namespace, name, entry) VALUES (?, ?, ?)",
+                (
+                    (self.namespace, name, json.dumps(entry, separators=(",", ":")))
+                    for name, entry in updated.items()
+                ),
+            )
+            connection.executemany(
+                "INSERT INTO blobs (namespace, name, blob) VALUES (?, ?, ?)",
+                (
+                    (self.namespace, name, blob)
+                    for name, entry in updated.items()
+                    for blob in set(entry["outputs"].values())
+                ),
+            )
+            connection.execute(
+                "INSERT INTO namespaces (namespace, used) VALUES (?, ?) "
+                "ON CONFLICT (namespace) DO UPDATE SET used = excluded.used",
+                (self.namespace, time.time()),
+            )
+
+    def expire_namespaces(self, max_age: float) -> set[str]:
+        """Remove the namespaces not used for max_age seconds, and get their blobs to collect"""
+
+        now: float = time.time()
+
+        with self._transaction() as connection:
+            # Namespaces written before the usage was tracked start counting from now
+            connection.execute(
+                "INSERT OR IGNORE INTO namespaces (namespace, used) "
+                "SELECT DISTINCT namespace, ? FROM entries",
+                (now,),
+            )
+            expired = [
+                namespace
+                for (namespace,) in connection.execute(
+                    "SELECT namespace FROM namespaces WHERE used < ? AND namespace != ?",
+                    (now - max_age, self.namespace),
+                )
+            ]
+            blobs: set[str] = set()
+
+            for namespace in expired:
+                rows = connection.execute(
+                    "SELECT blob FROM blobs WHERE namespace = ?", (namespace,)
+                )
+                blobs.update(blob for (blob,) in rows)
+                for table in ("entries", "blobs", "namespaces"):
+                    connection.execute(f"DELETE FROM {table} WHERE namespace = ?", (namespace,))
+
+        return blobs
+
+    def mark_garbage(self, blobs: Iterable[str]):
+        """Mark the dropped blobs as candidates for removal"""
+
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO garbage (blob) VALUES (?)", ((blob,) for blob in blobs)
+            )
+
+    def get_garbage(self) -> set[str]:
+        """Get the candidates for removal of all namespaces"""
+
+        with self._connect() as connection:
+            return {blob for (blob,) in connection.execute("SELECT blob FROM garbage")}
+
+    def unmark_garbage(self, blobs: Iterable[str]):
+        """Forget the removed or referenced again blobs"""
+
+        with self._transaction() as connection:
+            connection.executemany(
+                "DELETE FROM garbage WHERE blob = ?", ((blob,) for blob in blobs)
+            )
+
+    def get_referenced(self, blobs: Iterable[str]) -> set[str]:
+        """Get the blobs that are still referenced by any namespace"""
+
+        blobs = list(blobs)
+        referenced: set[str] = set()
+
+        if not blobs:
+            return referenced
+
+        with self._connect() as connection:
+            # Stay below the SQLite variable limit
+            for i in range(0, len(blobs), 500):
+                chunk = blobs[i : i + 500]
+                rows = connection.execute(
+                    f"SELECT DISTINCT blob FROM blobs WHERE blob IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                referenced.update(blob for (blob,) in rows)
+
+        return referenced
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Autocommit mode, transactions are started explicitly
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        try:
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "namespace TEXT NOT NULL, name TEXT NOT NULL, entry TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, name))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "namespace TEXT NOT NULL, name TEXT NOT NULL, blob TEXT NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS blobs_blob ON blobs (blob)")
+            connection.execute("CREATE INDEX IF NOT EXISTS blobs_name ON blobs (namespace, name)")
+            connection.execute("CREATE TABLE IF NOT EXISTS garbage (blob TEXT PRIMARY KEY)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS namespaces (namespace TEXT PRIMARY KEY, used REAL)"
+            )
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as connection:
+            # Take the write lock right away, so parallel jobs wait instead of failing mid-way
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            else:
+                connection.execute("COMMIT")
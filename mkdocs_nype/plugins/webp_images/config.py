@@ -1,7 +1,7 @@
 import os
 
 from mkdocs.config import Config
-from mkdocs.config.config_options import Choice, Optional, PathSpec, Type
+from mkdocs.config.config_options import Choice, ListOfItems, Optional, PathSpec, Type
 
 
 class WebpImagesConfig(Config):
@@ -12,9 +12,39 @@ class WebpImagesConfig(Config):
     cache_dir = Type(str, default=".cache/nype/webp_images")
     """Cache dir location to store converted images"""
 
+    cache_namespace = Optional(Type(str))
+    """Key of the project in a shared cache, defaults to the site_name, set it when projects with
+    the same site_name share the cache"""
+
+    namespace_expiry_days = Type(int, default=30)
+    """Days since the last build of a namespace before its entries are removed from a shared
+    cache, 0 to disable"""
+
+    blob_grace_period = Type(int, default=3600)
+    """Seconds since the last use before a dropped blob is removed, parallel builds sharing the
+    cache could still be linking it"""
+
+    verify_hashes = Type(bool, default=False)
+    """Always hash the sources, instead of trusting unchanged size, mtime and inode"""
+
     workers = Type(int, default=max(1, os.cpu_count() - 1))
     """Number of cores to use to process the images"""
 
+    executor = Choice(("thread", "process"), default="thread")
+    """Executor backend, `process` runs the decode and encode outside of the main GIL"""
+
+    schedule = Choice(("files", "pre_build"), default="files")
+    """When to start the conversions, `pre_build` scans the docs_dir to overlap with rendering"""
+
+    timeout = Type((int, float), default=2)
+    """Seconds to wait for each conversion task after the build, AVIF needs a higher value"""
+
+    batch_bytes = Type(int, default=0)
+    """Combine images smaller than this many bytes into tasks of about this size, 0 disables it"""
+
+    memory_budget = Optional(Type(int))
+    """Megabytes of decoded pixels (width * height * bands) allowed in flight across the workers"""
+
     lossless = Type(bool, default=False)
     """Lossless flag for the writer"""
 
@@ -30,5 +60,34 @@ class WebpImagesConfig(Config):
     ignore_mode = Choice(("processing", "deletion"), default="deletion")
     """Ignore mode to decide if the ignored patterns should prevent processing or deletion of old images"""
 
+    skip_original_copy = Type(bool, default=False)
+    """Don't copy converted originals to the site_dir, instead of deleting them after the build"""
+
+    min_savings = Optional(Type(int))
+    """Serve the original unless the WebP output is at least this many percent smaller. Pages
+    wait up to the timeout for the conversion of the changed images to decide, without cache for
+    all images, and serve the original if it takes longer"""
+
     add_sizes = Type(bool, default=True)
     """Add sizes (width/height) to `<img>` tags"""
+
+    widths = ListOfItems(Type(int), default=[])
+    """Widths of additional resized variants, added as `srcset` to `<img>` tags"""
+
+    max_size = Optional(Type(int))
+    """Maximum width and height of the outputs, larger images are scaled down while decoding"""
+
+    srcset_sizes = Type(str, default="100vw")
+    """Value of the `sizes` attribute added together with the `srcset`"""
+
+    avif = Type(bool, default=False)
+    """Also output AVIF files and wrap `<img>` tags in `<picture>`, requires Pillow AVIF support"""
+
+    avif_quality = Type(int, default=60)
+    """Quality level for the AVIF writer"""
+
+    report_file = Optional(Type(str))
+    """JSON lines file with per image timings and sizes, relative to the mkdocs.yml file"""
+
+    report_top = Type(int, default=5)
+    """Number of the slowest images to list in the build summary"""
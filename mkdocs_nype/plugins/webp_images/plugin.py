@@ -12,50 +12,112 @@ Parts adapted based on:
 MIT License Kamil Krzyśków (HRY) for Nype (npe.cm) and Fiori Tracker (fioritracker.org)
 """
 
+import functools
 import hashlib
 import json
 import logging
 import os
 import shutil
-from concurrent.futures import Future, ThreadPoolExecutor, thread
+import tempfile
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    TimeoutError,
+    thread,
+)
+from dataclasses import asdict, dataclass, replace
 from pathlib import Path
 from urllib.parse import urlsplit
 from xml.etree import ElementTree as etree
 
+import watchdog.events
+from mkdocs.config.defaults import MkDocsConfig
+from mkdocs.exceptions import PluginError
 from mkdocs.plugins import BasePlugin, PrefixedLogger, event_priority
 from mkdocs.structure import pages
 from mkdocs.structure.files import File
 from mkdocs.utils import templates
 from PIL import Image
+from PIL import __version__ as PILLOW_VERSION
 
 try:
     from jinja2 import pass_context as contextfilter  # type: ignore
 except ImportError:
     from jinja2 import contextfilter  # type: ignore
 
+try:
+    # Registers AVIF support for Pillow versions without native support
+    import pillow_avif  # type: ignore
+except ImportError:
+    pass
+
+from .cache import CacheIndex
 from .config import WebpImagesConfig
 
 
 class WebpImagesPlugin(BasePlugin[WebpImagesConfig]):
 
     def __init__(self):
-        self.executor: ThreadPoolExecutor = None
+        self.executor: Executor = None
         self.promises: list[Future] = []
+        self.queue: list[ConversionJob] = []
+        self.throttled: deque[tuple[Future, list[ConversionJob]]] = deque()
+        self.memory_in_flight: int = 0
+        self.memory_lock = threading.Lock()
 
         self.extensions: list[str] = None
         self.old_file_map: dict[str, File] = {}
 
-        self.cache_index: dict[str, str] = {}
+        self.cache_index: dict[str, dict] = {}
+        self.image_sizes: dict[str, dict] = {}
+        self.build_sizes: dict[str, tuple[int, int]] = {}
         self.processed_images: set[str] = set()
-        self.cache_index_file: Path = None
+        self.submitted_sources: dict[str, str] = {}
+        self.source_paths: dict[str, str] = {}
+        self.source_promises: dict[str, Future] = {}
+        self.decisions: dict[str, bool] = {}
+        self.cache_db: CacheIndex = None
+        self.updated_entries: dict[str, dict] = {}
+        self.removed_entries: set[str] = set()
 
         self.cache_base: Path = None
-        self.cache_image_base: Path = None
+        self.cache_blob_base: Path = None
         self.site_dir_path: Path = None
+        self.docs_dir: str = None
+        self.settings: EncoderSettings = None
+
+        self.scheduled: dict[str, str] = {}
+        self.relocations: dict[str, str] = {}
+        self.schedule_start: float = None
+        self.staging_dir: Path = None
+
+        self.is_serve: bool = False
+        self.is_dirty: bool = False
+        self.index_loaded: bool = False
+        self.warm_results: dict[str, ConversionResult] = {}
+        self.warm_settings: EncoderSettings = None
+        self.reused_count: int = 0
+        self.changes_lock = threading.Lock()
+        self.pending_changes: set[str] = None
+        self.changed_sources: set[str] = None
+
+    def on_startup(self, *, command, dirty):
+        self.is_serve = command == "serve"
+        self.is_dirty = dirty
 
     def on_config(self, config):
         if self.executor is None:
-            self.executor = ThreadPoolExecutor(max_workers=self.config.workers)
+            # Pillow holds the GIL for large parts of the encode, so allow to use processes
+            if self.config.executor == "process":
+                self.executor = ProcessPoolExecutor(max_workers=self.config.workers)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.config.workers)
 
         assert self.config.extensions, "config.extensions strings can't be empty"
 
@@ -67,42 +129,152 @@ class WebpImagesPlugin(BasePlugin[WebpImagesConfig]):
 
         assert self.extensions, "file extensions weren't loaded"
 
-        # Clear between server runs because images could change
-        self.cache_index.clear()
+        # Clear between server runs because images could change, the cache index and conversion
+        # results are kept warm in serve mode and invalidated based on the watcher events
+        if not self.is_serve:
+            self.cache_index.clear()
+            self.index_loaded = False
+        self.updated_entries.clear()
+        self.removed_entries.clear()
+        self.reused_count = 0
         self.processed_images.clear()
+        self.submitted_sources.clear()
+        self.source_paths.clear()
+        self.source_promises.clear()
+        self.decisions.clear()
+        self.build_sizes.clear()
         self.old_file_map.clear()
         self.promises.clear()
+        self.queue.clear()
+        self.throttled.clear()
+        self.memory_in_flight = 0
+        self.scheduled.clear()
+        self.relocations.clear()
+        self.schedule_start = None
 
         # Output directory
         self.site_dir_path = Path(config.site_dir)
 
+        # Only the docs_dir is watched for the changed sources
+        self.docs_dir = os.path.normpath(config.docs_dir)
+
+        if self.config.avif and ".avif" not in Image.registered_extensions():
+            raise PluginError(
+                "AVIF output requires Pillow>=11.2 with AVIF support or the pillow-avif-plugin"
+            )
+
+        self.settings = EncoderSettings(
+            lossless=self.config.lossless,
+            quality=self.config.quality,
+            widths=self.config.widths,
+            avif_quality=self.config.avif_quality if self.config.avif else None,
+            min_savings=self.config.min_savings,
+            max_size=self.config.max_size,
+        )
+
+        # Changes in mkdocs.yml invalidate the warm results
+        if self.settings != self.warm_settings:
+            self.warm_results.clear()
+            self.warm_settings = self.settings
+
         # Configure cache
         if self.config.cache:
-            lossless: str = "lossless-" if self.config.lossless else ""
             self.cache_base = Path(config.config_file_path).parent / self.config.cache_dir
-            self.cache_index_file = self.cache_base / "index.json"
-            self.cache_image_base = self.cache_base / "images" / f"{lossless}{self.config.quality}"
+            # The site_url is changed by serve and the checkout path differs between CI jobs
+            namespace: str = self.config.cache_namespace or config.site_name
+            self.cache_db = CacheIndex(self.cache_base / "index.sqlite", namespace=namespace)
+            self.cache_blob_base = self.cache_base / "blobs"
+
+            # The index.json and the images/ dir of the old cache layout are never read again
+            if not self.index_loaded:
+                remove_legacy_cache(self.cache_base)
 
         # Wrap the path resolution logic to easily proxy webp files
         pages._RelativePathTreeprocessor.path_to_url = wrap_path_to_url(
-            pages._RelativePathTreeprocessor.path_to_url, extensions=self.extensions
+            pages._RelativePathTreeprocessor.path_to_url,
+            extensions=self.extensions,
+            prefers_original=self._prefers_original,
+        )
+        templates.url_filter = wrap_url_filter(
+            templates.url_filter,
+            extensions=self.extensions,
+            get_original=self.old_file_map.get,
+            prefers_original=self._prefers_original,
         )
-        templates.url_filter = wrap_url_filter(templates.url_filter, extensions=self.extensions)
 
-        if self.config.add_sizes:
-            pages._RelativePathTreeprocessor.run = wrap_run(
-                pages._RelativePathTreeprocessor.run, extensions=self.extensions
-            )
+        # Always wrapped, the options are read on each call to follow the mkdocs.yml changes
+        pages._RelativePathTreeprocessor.run = wrap_run(
+            pages._RelativePathTreeprocessor.run,
+            extensions=self.extensions,
+            get_size=self._get_image_size,
+            is_converted=self._is_converted,
+            get_config=lambda: self.config,
+        )
+
+    def on_serve(self, server, /, *, config, builder):
+        """Track changed sources to only reconvert what changed during serve rebuilds"""
+
+        if self.pending_changes is not None:
+            return
+
+        self.pending_changes = set()
+
+        handler = watchdog.events.FileSystemEventHandler()
+        handler.on_any_event = self._on_docs_event
+        server.observer.schedule(handler, config.docs_dir, recursive=True)
+
+    def on_pre_build(self, *, config):
+        self._load_cache_index()
+
+        # Snapshot the changes since the previous build, None means everything could've changed
+        if self.pending_changes is not None:
+            with self.changes_lock:
+                self.changed_sources = self.pending_changes
+                self.pending_changes = set()
+
+        if self.config.schedule != "pre_build":
+            return
+
+        # The site_dir gets cleaned after on_pre_build, so the early conversions are staged,
+        # with cache enabled they're linked from the blob store instead
+        if not self.config.cache:
+            self.staging_dir = Path(tempfile.mkdtemp(prefix="nype_webp_images_"))
+
+        ignore_processing: bool = (
+            self.config.ignore_paths and self.config.ignore_mode == "processing"
+        )
+
+        # Discover the images before the Files are collected to overlap the conversion with
+        # the rendering. The dest_path is predicted to be the src_uri and fixed in on_files.
+        for root, dirs, filenames in os.walk(config.docs_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for filename in filenames:
+                stem, suffix = os.path.splitext(filename)
+                if suffix.lower() not in self.extensions:
+                    continue
+
+                # Skip if sibling webp exists
+                if stem + ".webp" in filenames:
+                    continue
+
+                src: str = os.path.join(root, filename)
+                old: str = Path(os.path.relpath(src, config.docs_dir)).as_posix()
+
+                if ignore_processing and self.config.ignore_paths.match_file(old):
+                    LOG.debug(f"Skipped processing of '{old}'")
+                    continue
+
+                new: str = old.rsplit(".", maxsplit=1)[0] + ".webp"
+                self._submit(src, old, new, staged=True)
+                self.scheduled[old] = new
+
+        self._flush_queue()
+        LOG.debug(f"Scheduled {len(self.scheduled)} WebP conversions before on_files")
 
     # Allow to inject files with other plugins
     # Blog plugin runs on -50
     @event_priority(-75)
     def on_files(self, files, /, *, config):
-        # Load cached file hashes
-        if self.config.cache and self.cache_index_file.exists():
-            with open(self.cache_index_file, encoding="utf-8") as file:
-                self.cache_index.update(json.load(file))
-
         ignore_processing: bool = (
             self.config.ignore_paths and self.config.ignore_mode == "processing"
         )
@@ -117,6 +289,21 @@ class WebpImagesPlugin(BasePlugin[WebpImagesConfig]):
             old: str = path.as_posix()
             new: str = path.with_suffix(".webp").as_posix()
 
+            # Already submitted in on_pre_build, only the dest_path could have changed
+            scheduled: str = self.scheduled.get(file.src_uri)
+            if scheduled is not None:
+                # Matched against the src_uri in on_pre_build, the ignored job stays scheduled,
+                # so on_post_build drops it like the other orphans
+                if ignore_processing and self.config.ignore_paths.match_file(old):
+                    LOG.debug(f"Skipped processing of '{old}'")
+                    del self.submitted_sources[file.src_uri]
+                    continue
+                del self.scheduled[file.src_uri]
+                if scheduled != new:
+                    self.relocations[scheduled] = new
+                self._register_original(old, file)
+                continue
+
             if ignore_processing and self.config.ignore_paths.match_file(old):
                 LOG.debug(f"Skipped processing of '{old}'")
                 continue
@@ -125,89 +312,988 @@ class WebpImagesPlugin(BasePlugin[WebpImagesConfig]):
             if files.get_file_from_path(new):
                 continue
 
-            # Setup future promise
-            src: str = file.abs_src_path
-            dest = self.site_dir_path / new
-            cached = (self.cache_image_base / new) if self.config.cache else None
-            self.promises.append(self.executor.submit(self._convert_image, src, dest, cached, new))
-
-            # Store file separately, because we remove the old files
-            self.old_file_map[old] = file
+            self._submit(file.abs_src_path, file.src_uri, new)
+            self._register_original(old, file)
 
             # TODO There was an attempt at using files.remove(file) and files.append(File.generated)
             # to directly target the .webp files inside wrap_path_to_url, but the images are created
             # concurrently, so they're often not ready before Markdown processing for being copied.
             # One solution could be to move the future.result() from on_post_build to on_env, but this
             # would likely impact the UX performance more than removing the old files in on_post_build.
-            # files.remove(file)
-            # files.append(File.generated(config, new, abs_src_path=str(self.site_dir_path / new)))
+            # Removing the file or excluding it also breaks the link validation of MkDocs, so with
+            # skip_original_copy the file stays in Files and only its copy step is skipped, while the
+            # outputs are placed in on_post_build.
 
-    def _convert_image(self, src: str, dest: Path, cache_dest: Path | None, name: str):
-        dest.parent.mkdir(parents=True, exist_ok=True)
-        self.processed_images.add(name)
+        self._flush_queue()
 
-        # Check if there is a cached entry for the given source hash
-        cached_entry = False
-        if cache_dest:
-            image_hash = get_image_hash_key(src)
-            cached_hash = self.cache_index.get(name)
-            cached_entry = cached_hash == image_hash
+    def on_post_build(self, *, config):
+        render_end: float = time.perf_counter()
 
-        if cached_entry and cache_dest.exists():
-            shutil.copyfile(cache_dest, dest)
-            return
+        # Scheduled images that didn't end up in Files, e.g. excluded docs, or were ignored
+        orphans: set[str] = set(self.scheduled)
 
-        with Image.open(src) as image:
-            image.save(dest, lossless=self.config.lossless, quality=self.config.quality)
+        # Blobs that are no longer referenced by the given image
+        dropped_blobs: set[str] = set()
 
-        if cache_dest:
-            cache_dest.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copyfile(dest, cache_dest)
-            self.cache_index[name] = image_hash
+        # Per image telemetry for the summary and the report file
+        records: list[ConversionResult] = []
 
-    def on_post_build(self, *, config):
-        for promise in self.promises:
+        for result in self._iter_results():
+            if result.src_uri in orphans:
+                self.processed_images.discard(result.name)
+                # Nothing references the outputs, so the blobs go through the garbage collection
+                dropped_blobs.update(blob for blob in result.outputs.values() if blob)
+                continue
+
+            records.append(result)
+
+            # The pages that timed out waiting for the result already link the original
+            original: bool = self.decisions.setdefault(result.src_uri, result.original)
+            if original and not result.original and result.dest is not None:
+                for suffix in result.outputs:
+                    get_output_path(result.dest, suffix).unlink(missing_ok=True)
+
+            # Move staged conversions in place, taking the dest_path changes into account,
+            # the outputs of images served as originals stay in the blob store only
+            target: Path = self.site_dir_path / self.relocations.get(result.name, result.name)
             try:
-                promise.result(timeout=2)
-            except Exception as error:
-                self.executor.shutdown(wait=False, cancel_futures=True)
-                self.executor._threads.clear()
-                thread._threads_queues.clear()
-                raise
+                for suffix, blob in result.outputs.items():
+                    if original:
+                        break
+                    self._place_output(
+                        get_output_path(result.dest, suffix) if result.dest else None,
+                        get_output_path(target, suffix),
+                        blob,
+                    )
+            except FileNotFoundError:
+                # A parallel build sharing the cache removed the blob in the meantime
+                LOG.info(f"Blob of '{result.src_uri}' went missing, converting it again")
+                self._convert_again(result, target)
+
+            # Keep the result to reuse it in serve rebuilds, the outputs now reside in the target
+            if self.is_serve and original == result.original:
+                self.warm_results[result.name] = replace(result, dest=target)
+
+            # Keep the sizes in memory for wrap_run, sizes persist between serve rebuilds
+            self.image_sizes[result.src_uri] = {
+                "stat": result.stat,
+                "size": [result.width, result.height],
+            }
+
+            # Merge the worker results in the main process to keep the index consistent
+            if result.image_hash:
+                entry: dict = {
+                    "hash": result.image_hash,
+                    "outputs": result.outputs,
+                    "stat": result.stat,
+                    "src": result.src_uri,
+                    "size": [result.width, result.height],
+                    "original": result.original,
+                    "min_savings": self.config.min_savings,
+                }
+                previous: dict = self.cache_index.get(result.name)
+                if previous:
+                    dropped_blobs.update(get_entry_blobs(previous) - get_entry_blobs(entry))
+                if previous != entry:
+                    self.cache_index[result.name] = entry
+                    self.updated_entries[result.name] = entry
+
+        build_end: float = time.perf_counter()
+
+        if self.staging_dir is not None:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir = None
+
+        if self.promises:
+            LOG.info(
+                f"Processed {len(records)} WebP conversions in "
+                f"{build_end - self.schedule_start:.2f}s, "
+                f"{build_end - render_end:.2f}s of them added after rendering"
+                + (f", {self.reused_count} reused from the previous build" if self.is_serve else "")
+            )
+        else:
+            LOG.info("Processed 0 WebP conversions")
 
-        LOG.info(f"Processed {len(self.promises)} WebP conversions")
+        if records:
+            self._report(records, config)
 
         # Clean the old images after the build to not copy them for deployment
         # TODO See note in on_files
-        ignore_deletion: bool = self.config.ignore_paths and self.config.ignore_mode == "deletion"
         for file in self.old_file_map.values():
-            if ignore_deletion and self.config.ignore_paths.match_file(file.src_uri):
+            if self._keeps_original(file):
                 LOG.debug(f"Skipped deletion of '{file.src_uri}'")
                 continue
+            # The WebP output didn't save enough, the original has to be copied if it was skipped
+            if self.decisions.get(file.src_uri):
+                LOG.debug(f"Kept the original '{file.src_uri}'")
+                if "copy_file" in vars(file):
+                    del file.copy_file
+                    file.copy_file()
+                continue
+            # Not copied in the first place
+            if self.config.skip_original_copy or self.is_serve:
+                continue
             os.remove(file.abs_dest_path)
 
-        # Clean up obsolete caches
-        for cached_path in list(self.cache_index):
-            if cached_path in self.processed_images:
-                continue
+        # Clean up obsolete caches, blobs can be shared by multiple images
+        for cached_name in list(self.cache_index):
+            if cached_name not in self.processed_images:
+                dropped_blobs.update(get_entry_blobs(self.cache_index.pop(cached_name)))
+                self.removed_entries.add(cached_name)
 
-            self.cache_index.pop(cached_path)
+        for warm_name in list(self.warm_results):
+            if warm_name not in self.processed_images:
+                self.warm_results.pop(warm_name)
 
-            cached_path = self.cache_image_base / cached_path
-            if cached_path.exists():
-                LOG.debug(f"Removing '{cached_path}' from cache")
-                cached_path.unlink()
+        if not self.config.cache:
+            return
 
-        if self.config.cache:
-            with open(self.cache_index_file, "w", encoding="utf-8") as file:
-                json.dump(self.cache_index, file, ensure_ascii=False, indent=2)
+        # Only the changed entries are written, in a single atomic transaction,
+        # which also marks the namespace as used to keep it from expiring
+        self.cache_db.save(self.updated_entries, self.removed_entries)
+
+        # Projects that stopped building or got renamed would pin their blobs forever
+        if self.config.namespace_expiry_days > 0:
+            dropped_blobs.update(
+                self.cache_db.expire_namespaces(self.config.namespace_expiry_days * 86400)
+            )
+
+        self._collect_garbage(dropped_blobs)
+
+    def _collect_garbage(self, dropped_blobs: set[str]):
+        """Remove the unreferenced blobs, which weren't used by any build for the grace period.
+        The candidates are kept in the cache index until then, including the ones of other builds"""
+
+        self.cache_db.mark_garbage(dropped_blobs)
+
+        candidates: set[str] = self.cache_db.get_garbage()
+
+        # Blobs could be still referenced by other images or other projects sharing the cache
+        done: set[str] = self.cache_db.get_referenced(candidates)
+        expiry: float = time.time() - self.config.blob_grace_period
+
+        for blob in candidates - done:
+            blob_path = get_blob_path(self.cache_blob_base, blob)
+            try:
+                if blob_path.stat().st_mtime > expiry:
+                    continue
+                LOG.debug(f"Removing '{blob_path}' from cache")
+                blob_path.unlink()
+            except FileNotFoundError:
+                pass
+            done.add(blob)
+
+        self.cache_db.unmark_garbage(done)
+
+    def _convert_again(self, result: "ConversionResult", target: Path):
+        """Convert the image in the main thread, the missing blobs are encoded again"""
+
+        convert_image(
+            self.source_paths[result.name],
+            target,
+            self.cache_blob_base,
+            self.cache_index.get(result.name),
+            name=result.name,
+            src_uri=result.src_uri,
+            verify_hashes=self.config.verify_hashes,
+            settings=self.settings,
+            retry=False,
+        )
 
     def on_shutdown(self):
         if self.executor is not None:
-            self.executor.shutdown(wait=False, cancel_futures=True)
+            # Process pools have to join their management thread, or they fail at interpreter exit
+            wait: bool = isinstance(self.executor, ProcessPoolExecutor)
+            self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _load_cache_index(self):
+        """Load cached file hashes, once per serve session"""
+
+        if self.index_loaded:
+            return
+
+        self.index_loaded = True
+
+        if self.config.cache:
+            self.cache_index.update(self.cache_db.load())
+
+        # Sizes from the previous build, validated against the stat in _get_image_size
+        for entry in self.cache_index.values():
+            if entry.get("src") and entry["src"] not in self.image_sizes:
+                self.image_sizes[entry["src"]] = {"stat": entry["stat"], "size": entry["size"]}
+
+    def _get_image_size(self, file: File) -> tuple[int, int]:
+        """Get the width and height, only open the image if the source changed or is unknown"""
+
+        size = self.build_sizes.get(file.src_uri)
+        if size is not None:
+            return size
+
+        known: dict = self.image_sizes.get(file.src_uri)
+        if known and self._is_unchanged(file.abs_src_path, known["stat"]):
+            size = tuple(known["size"])
+        else:
+            with Image.open(file.abs_src_path) as image:
+                size = image.size
+
+        # The sizes of the sources are kept, as the max_size could change between builds
+        size = fit_size(size, self.config.max_size)
+        self.build_sizes[file.src_uri] = size
+        return size
+
+    def _keeps_original(self, file: File) -> bool:
+        """Check if the original is kept in the site_dir due to the ignore_paths"""
+
+        ignore_deletion: bool = self.config.ignore_paths and self.config.ignore_mode == "deletion"
+        return bool(ignore_deletion and self.config.ignore_paths.match_file(file.src_uri))
+
+    def _register_original(self, old: str, file: File):
+        """Store file separately, because the originals are removed or not copied"""
+
+        self.old_file_map[old] = file
+
+        # There is nothing to deploy in serve mode, so there is no need for the deletion sweep
+        if (self.config.skip_original_copy or self.is_serve) and not self._keeps_original(file):
+            # Shadow the method on the instance, the File objects are recreated for each build
+            file.copy_file = skip_copy_file
+
+    def _on_docs_event(self, event: watchdog.events.FileSystemEvent):
+        """Called from the watchdog observer thread"""
+
+        with self.changes_lock:
+            self.pending_changes.add(os.path.normpath(event.src_path))
+            if getattr(event, "dest_path", None):
+                self.pending_changes.add(os.path.normpath(event.dest_path))
+
+    def _is_unchanged(self, src: str, stat: list[int] | None) -> bool:
+        """Check if the source wasn't touched according to the watcher events, the sources
+        outside of the docs_dir, e.g. theme images, have no events and compare the stat instead"""
+
+        src = os.path.normpath(src)
+
+        if self.changed_sources is not None and src.startswith(self.docs_dir + os.sep):
+            return src not in self.changed_sources
+
+        return stat is not None and stat == get_stat_key(src)
+
+    def _is_converted(self, file: File) -> bool:
+        """Check if the file was submitted for conversion and its WebP output is served"""
+
+        return file.src_uri in self.submitted_sources and not self._prefers_original(file)
+
+    def _prefers_original(self, file: File | None) -> bool:
+        """Check if the WebP output didn't save enough according to min_savings. The decision
+        is taken from the cache index if the source is unchanged, otherwise the rendering has to
+        wait for the conversion of this image, so without cache it waits for every image."""
+
+        if self.config.min_savings is None or file is None:
+            return False
+
+        name: str = self.submitted_sources.get(file.src_uri)
+        if name is None:
+            return False
+
+        decision: bool = self.decisions.get(file.src_uri)
+        if decision is not None:
+            return decision
+
+        entry: dict = self.cache_index.get(name)
+        if (
+            entry
+            and entry.get("min_savings") == self.config.min_savings
+            and entry["src"] == file.src_uri
+            and entry["stat"] == get_stat_key(file.abs_src_path)
+            and entry["outputs"].get(".webp")
+            == get_blob_key(entry["hash"], "webp", None, self.settings)
+        ):
+            decision = entry["original"]
+        else:
+            # The original always exists, so it's served if the conversion takes too long,
+            # on_post_build keeps the decision to match the links of the rendered pages
+            promise: Future = self.source_promises[file.src_uri]
+            try:
+                results: list[ConversionResult] = promise.result(timeout=self.config.timeout)
+            except TimeoutError:
+                LOG.info(f"Timed out waiting for '{file.src_uri}', serving the original")
+                decision = True
+            except Exception:
+                # Re-raised in on_post_build
+                return False
+            else:
+                decision = next(r.original for r in results if r.src_uri == file.src_uri)
+
+        self.decisions[file.src_uri] = decision
+        return decision
+
+    def _place_output(self, dest: Path | None, target: Path, blob: str | None):
+        """Link the blob or move the staged file to the target in the site_dir"""
+
+        if dest is None:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(get_blob_path(self.cache_blob_base, blob), target)
+        elif dest != target:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(dest, target)
+
+    def _submit(self, src: str, src_uri: str, new: str, *, staged: bool = False):
+        """Setup future promise, the worker only gets paths and returns small metadata,
+        so it can run in a separate process without sharing the cache_index"""
+
+        if self.schedule_start is None:
+            self.schedule_start = time.perf_counter()
+
+        self.processed_images.add(new)
+        self.submitted_sources[src_uri] = new
+        self.source_paths[new] = src
+
+        # Reuse the warm result in serve rebuilds, the outputs are linked from the blob store,
+        # as the site_dir could have been cleaned, or are already in place without cache
+        warm: ConversionResult = self.warm_results.get(new)
+        reusable: bool = self.config.cache or self.is_dirty
+        if reusable and warm and warm.src_uri == src_uri and self._is_unchanged(src, warm.stat):
+            promise = Future()
+            stats = ConversionStats(warm.stats.source_bytes, warm.stats.output_bytes, 0, 0, 0, True)
+            dest = None if self.config.cache else warm.dest
+            promise.set_result([replace(warm, dest=dest, stats=stats)])
+            self.source_promises[src_uri] = promise
+            self.promises.append(promise)
+            self.reused_count += 1
+            return
+
+        if not staged:
+            dest = self.site_dir_path / new
+        elif self.config.cache:
+            dest = None
+        else:
+            dest = self.staging_dir / new
+
+        # Submitted in _flush_queue, once the sizes of all candidates are known
+        job = ConversionJob(
+            src, dest, self.cache_index.get(new), new, src_uri, os.stat(src).st_size
+        )
+        if self.config.memory_budget and self._needs_decode(src, job.cached_entry):
+            job.memory = get_decoded_size(src, self.config.max_size)
+        self.queue.append(job)
+
+    def _needs_decode(self, src: str, cached_entry: dict | None) -> bool:
+        """Check if the conversion will decode the image, the cache hits only link the blobs,
+        so they're not charged against the memory_budget. Mirrors the checks of convert_image"""
+
+        if not self.config.cache or not cached_entry:
+            return True
+
+        if cached_entry.get("stat") != get_stat_key(src) or "size" not in cached_entry:
+            return True
+
+        width, _ = fit_size(cached_entry["size"], self.settings.max_size)
+
+        # The other outputs are skipped for the originals, as long as the decision holds
+        outputs = get_expected_outputs(
+            cached_entry["hash"],
+            width,
+            self.settings,
+            main_only=cached_entry.get("original")
+            and cached_entry.get("min_savings") == self.config.min_savings,
+        )
+
+        return not all(get_blob_path(self.cache_blob_base, blob).exists() for *_, blob in outputs)
+
+    def _flush_queue(self):
+        """Submit the queued jobs largest first, so a huge image discovered last doesn't become
+        the critical path, and combine the small images at the tail into batches"""
+
+        self.queue.sort(key=lambda job: job.size, reverse=True)
+
+        batch: list[ConversionJob] = []
+        batch_size: int = 0
+
+        for job in self.queue:
+            if job.size >= self.config.batch_bytes:
+                self._submit_batch([job])
+                continue
+
+            batch.append(job)
+            batch_size += job.size
+            if batch_size >= self.config.batch_bytes:
+                self._submit_batch(batch)
+                batch, batch_size = [], 0
+
+        if batch:
+            self._submit_batch(batch)
+
+        self.queue.clear()
+
+    def _submit_batch(self, jobs: list["ConversionJob"]):
+        if self.config.memory_budget:
+            # Handed to the executor in _dispatch, once the memory_budget allows it
+            promise = Future()
+            self.throttled.append((promise, jobs))
+            self._dispatch()
+        else:
+            promise: Future = self._submit_convert(jobs)
+
+        self.promises.append(promise)
+
+        for job in jobs:
+            self.source_promises[job.src_uri] = promise
+
+    def _submit_convert(self, jobs: list["ConversionJob"]) -> Future:
+        return self.executor.submit(
+            convert_batch,
+            jobs,
+            self.cache_blob_base if self.config.cache else None,
+            verify_hashes=self.config.verify_hashes,
+            settings=self.settings,
+        )
+
+    def _dispatch(self):
+        """Submit the throttled tasks while the estimated decoded size in flight fits the budget,
+        called from the main thread and from the done callbacks of the executor"""
+
+        budget: int = self.config.memory_budget * 1024 * 1024
+
+        while True:
+            with self.memory_lock:
+                if not self.throttled:
+                    return
+
+                promise, jobs = self.throttled[0]
+                memory: int = sum(job.memory for job in jobs)
+
+                # A single task over the budget still runs, just alone
+                if self.memory_in_flight and self.memory_in_flight + memory > budget:
+                    return
+
+                self.throttled.popleft()
+                self.memory_in_flight += memory
+
+            if not promise.set_running_or_notify_cancel():
+                with self.memory_lock:
+                    self.memory_in_flight -= memory
+                continue
+
+            inner: Future = self._submit_convert(jobs)
+            inner.add_done_callback(functools.partial(self._release, promise, memory))
 
+    def _release(self, promise: Future, memory: int, inner: Future):
+        with self.memory_lock:
+            self.memory_in_flight -= memory
 
-def get_image_hash_key(src: str, algo: str = "sha256", chunk_size=4096):
+        try:
+            promise.set_result(inner.result())
+        except BaseException as error:
+            promise.set_exception(error)
+
+        self._dispatch()
+
+    def _iter_results(self) -> Iterator["ConversionResult"]:
+        """Wait for the promises in the submission order, each one holds a batch of results"""
+
+        for promise in self.promises:
+            wait_start: float = time.perf_counter()
+            try:
+                results: list[ConversionResult] = promise.result(timeout=self.config.timeout)
+            except Exception as error:
+                self._abort_executor()
+                raise
+            wait_ms: float = (time.perf_counter() - wait_start) * 1000
+
+            for result in results:
+                result.stats.wait_ms = wait_ms
+                yield result
+
+    def _report(self, records: list["ConversionResult"], config: MkDocsConfig):
+        """Log the summary of the conversions and write the optional JSON lines report"""
+
+        hits: int = sum(1 for record in records if record.stats.cache_hit)
+        source_bytes: int = sum(record.stats.source_bytes for record in records)
+        output_bytes: int = sum(
+            record.stats.source_bytes if record.original else record.stats.output_bytes
+            for record in records
+        )
+
+        LOG.info(
+            f"Cache hit rate {hits}/{len(records)} ({hits / len(records):.0%}), "
+            f"WebP outputs saved {format_bytes(source_bytes - output_bytes)} "
+            f"({format_bytes(source_bytes)} -> {format_bytes(output_bytes)})"
+        )
+
+        slowest = sorted(records, key=lambda r: r.stats.decode_ms + r.stats.encode_ms, reverse=True)
+        for record in slowest[: self.config.report_top]:
+            if record.stats.cache_hit:
+                break
+            LOG.info(
+                f"Slow conversion '{record.src_uri}': decode {record.stats.decode_ms:.0f}ms, "
+                f"encode {record.stats.encode_ms:.0f}ms, waited {record.stats.wait_ms:.0f}ms"
+            )
+
+        if not self.config.report_file:
+            return
+
+        report_path = Path(config.config_file_path).parent / self.config.report_file
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(report_path, "w", encoding="utf-8") as file:
+            for record in records:
+                line = {"name": record.name, "src": record.src_uri, **asdict(record.stats)}
+                line = {k: round(v, 2) if isinstance(v, float) else v for k, v in line.items()}
+                file.write(json.dumps(line) + "\n")
+
+        LOG.debug(f"Written the report to '{report_path}'")
+
+    def _abort_executor(self):
+        """Cancel pending work and make sure that hanging threads don't block the interpreter exit"""
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        with self.memory_lock:
+            while self.throttled:
+                self.throttled.popleft()[0].cancel()
+
+        if isinstance(self.executor, ThreadPoolExecutor):
+            self.executor._threads.clear()
+            thread._threads_queues.clear()
+
+
+@dataclass
+class ConversionResult:
+    """Small picklable result of a conversion, merged into the cache index in the main process"""
+
+    name: str
+    src_uri: str
+    image_hash: str | None
+    stat: list[int] | None
+    width: int
+    height: int
+    dest: Path | None
+    outputs: dict[str, str | None]
+    """Mapping of output suffixes like `.webp` or `-480w.avif` to blobs, None without cache"""
+
+    original: bool
+    """The WebP output didn't save enough, so the original is served instead"""
+
+    stats: "ConversionStats"
+    """Telemetry for the report"""
+
+
+@dataclass
+class ConversionJob:
+    """Arguments of a single conversion, kept small to pass it to a worker process"""
+
+    src: str
+    dest: Path | None
+    cached_entry: dict | None
+    name: str
+    src_uri: str
+    size: int
+    """Source file size in bytes used for the scheduling"""
+
+    memory: int = 0
+    """Estimated decoded size in bytes used for the memory_budget throttling"""
+
+
+@dataclass
+class ConversionStats:
+    """Per image telemetry, output_bytes only refer to the main WebP output"""
+
+    source_bytes: int
+    output_bytes: int
+    hash_ms: float
+    decode_ms: float
+    encode_ms: float
+    cache_hit: bool
+    wait_ms: float = 0
+    """Time spent blocking on the result in on_post_build"""
+
+
+@dataclass
+class EncoderSettings:
+    """Picklable encoder settings passed to the workers"""
+
+    lossless: bool
+    quality: int
+    widths: list[int]
+    avif_quality: int | None
+    """None disables the AVIF output"""
+
+    min_savings: int | None
+    """None always serves the WebP output"""
+
+    max_size: int | None
+    """Maximum width and height of the outputs, None keeps the original resolution"""
+
+    def prefers_original(self, source_bytes: int, output_bytes: int) -> bool:
+        if self.min_savings is None:
+            return False
+        return output_bytes * 100 > source_bytes * (100 - self.min_savings)
+
+    def get_formats(self) -> tuple[str, ...]:
+        return ("webp", "avif") if self.avif_quality is not None else ("webp",)
+
+    def get_save_options(self, fmt: str) -> dict:
+        if fmt == "avif":
+            return {"quality": self.avif_quality}
+        return {"lossless": self.lossless, "quality": self.quality}
+
+
+def convert_batch(
+    jobs: list[ConversionJob],
+    blob_base: Path | None,
+    *,
+    verify_hashes: bool,
+    settings: EncoderSettings,
+) -> list[ConversionResult]:
+    """Convert the jobs one after another in a single task to cut the per-future overhead"""
+
+    return [
+        convert_image(
+            job.src,
+            job.dest,
+            blob_base,
+            job.cached_entry,
+            name=job.name,
+            src_uri=job.src_uri,
+            verify_hashes=verify_hashes,
+            settings=settings,
+        )
+        for job in jobs
+    ]
+
+
+def convert_image(
+    src: str,
+    dest: Path | None,
+    blob_base: Path | None,
+    cached_entry: dict | None,
+    *,
+    name: str,
+    src_uri: str,
+    verify_hashes: bool,
+    settings: EncoderSettings,
+    retry: bool = True,
+) -> ConversionResult:
+    """Convert the image to WebP, defined on module level to be usable in a process pool"""
+
+    if dest is not None:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+
+    stat = get_stat_key(src)
+
+    # Skip hashing if the source file wasn't touched since the last build
+    start = time.perf_counter()
+    image_hash = None
+    if blob_base is None:
+        pass
+    elif not verify_hashes and cached_entry and cached_entry.get("stat") == stat:
+        image_hash = cached_entry["hash"]
+    else:
+        image_hash = get_image_hash_key(src)
+    hash_ms = (time.perf_counter() - start) * 1000
+
+    outputs: dict[str, str | None] = {}
+    output_bytes = 0
+    decode_ms = encode_ms = 0.0
+    cache_hit = True
+    original = False
+
+    # Image.open only reads the headers, the image is decoded once if any output is missing,
+    # and the resized variant is shared by all of the formats
+    with Image.open(src) as image:
+        source_width, source_height = image.size
+        width, height = fit_size(image.size, settings.max_size)
+
+        # JPEG decoders can scale down by powers of 2, so the full resolution is never held
+        if (width, height) != image.size:
+            image.draft(image.mode, (width, height))
+
+        variant: Image.Image = None
+        variant_of: int | None = None
+
+        for variant_width, fmt, suffix, blob in get_expected_outputs(image_hash, width, settings):
+            # The resized variant is shared by the formats of the same width
+            if variant_width != variant_of:
+                variant, variant_of = None, variant_width
+
+            # Without cache write directly to the output, otherwise use the content-addressed
+            # store, where identical images with the same settings share one blob
+            if blob is None:
+                path = get_output_path(dest, suffix)
+            else:
+                path = get_blob_path(blob_base, blob)
+
+            outputs[suffix] = blob
+
+            if blob is None or not touch_blob(path):
+                if cache_hit:
+                    cache_hit = False
+                    start = time.perf_counter()
+                    image.load()
+                    image = get_rgb_image(image)
+                    decode_ms = (time.perf_counter() - start) * 1000
+
+                    # Integer downscaling is cheap and frees the full resolution pixels early
+                    factor = min(image.width // width, image.height // height)
+                    if factor > 1:
+                        image = image.reduce(factor)
+
+                start = time.perf_counter()
+                if variant is None and variant_width is None:
+                    variant = fit_image(image, (width, height))
+                elif variant is None:
+                    variant = resize_image(image, variant_width)
+                if blob is None:
+                    variant.save(path, format=fmt.upper(), **settings.get_save_options(fmt))
+                else:
+                    save_blob(variant, path, fmt, settings)
+                encode_ms += (time.perf_counter() - start) * 1000
+
+            # The main WebP output is always the first one, so the other outputs are skipped
+            # when it doesn't save enough, the blob is kept to not encode it again
+            if suffix == ".webp":
+                output_bytes = path.stat().st_size
+                original = settings.prefers_original(stat[0], output_bytes)
+                if original:
+                    if blob is None:
+                        path.unlink()
+                        outputs.clear()
+                    break
+
+    # The dest is unknown for staged conversions, it is linked in the main process
+    if blob_base is not None and dest is not None and not original:
+        try:
+            for suffix, blob in outputs.items():
+                link_or_copy(get_blob_path(blob_base, blob), get_output_path(dest, suffix))
+        except FileNotFoundError:
+            if not retry:
+                raise
+            # A parallel build sharing the cache removed the blob in the meantime, the second
+            # attempt encodes the missing blobs again
+            return convert_image(
+                src,
+                dest,
+                blob_base,
+                cached_entry,
+                name=name,
+                src_uri=src_uri,
+                verify_hashes=verify_hashes,
+                settings=settings,
+                retry=False,
+            )
+
+    return ConversionResult(
+        name,
+        src_uri,
+        image_hash,
+        stat,
+        source_width,
+        source_height,
+        dest,
+        outputs,
+        original,
+        ConversionStats(stat[0], output_bytes, hash_ms, decode_ms, encode_ms, cache_hit),
+    )
+
+
+def format_bytes(size: int) -> str:
+    """Human readable size, negative values stay negative"""
+
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+
+    return f"{size:.1f}GiB"
+
+
+def save_blob(image: Image.Image, blob_path: Path, fmt: str, settings: EncoderSettings):
+    """Save the blob if it doesn't exist yet"""
+
+    if blob_path.exists():
+        return
+
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write to a unique temporary file first, as other workers or projects share the store
+    temp_path = blob_path.with_name(f"{blob_path.stem}.{os.getpid()}-{threading.get_ident()}.tmp")
+    image.save(temp_path, format=fmt.upper(), **settings.get_save_options(fmt))
+    os.replace(temp_path, blob_path)
+
+
+def fit_size(size: tuple[int, int], max_size: int | None) -> tuple[int, int]:
+    """Scale the size down to fit max_size in both dimensions, keeping the aspect ratio"""
+
+    width, height = size
+    if not max_size or max(width, height) <= max_size:
+        return width, height
+
+    scale = max_size / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def get_rgb_image(image: Image.Image) -> Image.Image:
+    """Convert to RGB(A) like the WebP encoder does on save, as reduce and LANCZOS don't support
+    e.g. palette, bilevel or 16-bit images"""
+
+    if image.mode in ("RGB", "RGBA"):
+        return image
+
+    return image.convert("RGBA" if image.has_transparency_data else "RGB")
+
+
+def fit_image(image: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """Resize the image to the exact size, the draft and reduce could have left it larger"""
+
+    if image.size == size:
+        return image
+
+    return image.resize(size, Image.Resampling.LANCZOS)
+
+
+def get_decoded_size(src: str, max_size: int | None) -> int:
+    """Estimate the memory of the decoded image in bytes (width * height * bands) from the headers"""
+
+    with Image.open(src) as image:
+        width, height = image.size
+        bands = len(image.getbands())
+        target = fit_size(image.size, max_size)
+
+        # JPEG draft scales by powers of 2 and keeps at least the target size, while the other
+        # formats decode the full image first
+        if image.format == "JPEG" and target != image.size:
+            width, height = min(width, target[0] * 2), min(height, target[1] * 2)
+
+    return width * height * bands
+
+
+def resize_image(image: Image.Image, width: int | None) -> Image.Image:
+    """Resize the image to the given width, keeping the aspect ratio. None keeps the original"""
+
+    if width is None:
+        return image
+
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.Resampling.LANCZOS)
+
+
+def get_variant_widths(widths: list[int], width: int) -> list[int]:
+    """Only downscale, so skip the widths that aren't smaller than the original"""
+
+    return sorted({w for w in widths if 0 < w < width})
+
+
+def get_output_suffix(fmt: str, width: int | None = None) -> str:
+    """Suffix of the output, e.g. `.webp` or `-480w.avif` for a resized variant"""
+
+    if width is None:
+        return f".{fmt}"
+
+    return f"-{width}w.{fmt}"
+
+
+def get_expected_outputs(
+    image_hash: str | None, width: int, settings: EncoderSettings, *, main_only: bool = False
+) -> list[tuple[int | None, str, str, str | None]]:
+    """Get the variant width, format, suffix and blob of each output in the encoding order,
+    starting with the main WebP output. The blobs are None without the image_hash."""
+
+    outputs: list[tuple[int | None, str, str, str | None]] = []
+
+    for variant_width in [None, *get_variant_widths(settings.widths, width)]:
+        for fmt in settings.get_formats():
+            blob = get_blob_key(image_hash, fmt, variant_width, settings) if image_hash else None
+            outputs.append((variant_width, fmt, get_output_suffix(fmt, variant_width), blob))
+
+            if main_only:
+                return outputs
+
+    return outputs
+
+
+def get_output_path(path: Path, suffix: str) -> Path:
+    """Path of the output based on the main WebP path, e.g. image.webp -> image-480w.avif"""
+
+    return path.with_name(path.stem + suffix)
+
+
+def get_blob_key(image_hash: str, fmt: str, width: int | None, settings: EncoderSettings) -> str:
+    """Combine the source hash with the encoder settings to get the blob name"""
+
+    options = settings.get_save_options(fmt)
+    if fmt == "webp":
+        key = f"{image_hash}:lossless={options['lossless']}:quality={options['quality']}"
+    else:
+        key = f"{image_hash}:format={fmt}:quality={options['quality']}"
+
+    key += f":pillow={PILLOW_VERSION}"
+    if settings.max_size:
+        key += f":max_size={settings.max_size}"
+    if width is not None:
+        key += f":width={width}"
+
+    return hashlib.sha256(key.encode()).hexdigest() + f".{fmt}"
+
+
+def get_entry_blobs(entry: dict) -> set[str]:
+    """All blobs referenced by the given cache index entry"""
+
+    return set(entry["outputs"].values())
+
+
+def get_blob_path(blob_base: Path, blob: str) -> Path:
+    """Shard the blobs in sub directories to avoid huge flat directories"""
+
+    return blob_base / blob[:2] / blob
+
+
+def skip_copy_file(dirty: bool = False):
+    """Replacement for File.copy_file of converted originals"""
+
+
+def touch_blob(blob_path: Path) -> bool:
+    """Mark the blob as used for the garbage collection of parallel builds, False if it's missing"""
+
+    try:
+        os.utime(blob_path)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def link_or_copy(src: Path, dest: Path):
+    """Hard link the file to avoid copying, fallback to a copy e.g. across devices"""
+
+    if dest.exists():
+        dest.unlink()
+
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def remove_legacy_cache(cache_base: Path):
+    """Delete the JSON index and the cached images, replaced by the SQLite index and the blobs"""
+
+    legacy_index = cache_base / "index.json"
+    if legacy_index.exists():
+        LOG.info(f"Removing the old cache index '{legacy_index}'")
+        legacy_index.unlink()
+
+    legacy_images = cache_base / "images"
+    if legacy_images.is_dir():
+        LOG.info(f"Removing the old cached images '{legacy_images}'")
+        shutil.rmtree(legacy_images, ignore_errors=True)
+
+
+def get_stat_key(src: str) -> list[int]:
+    """Size, modification time and inode of the file, list to compare with the JSON index"""
+
+    stat = os.stat(src)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def get_image_hash_key(src: str, algo: str = "sha256", chunk_size=1024 * 1024):
     """Load the file via stream and calculate hash during the process"""
 
     calculated_hash = hashlib.new(algo)
@@ -219,7 +1305,7 @@ def get_image_hash_key(src: str, algo: str = "sha256", chunk_size=4096):
     return calculated_hash.hexdigest()
 
 
-def wrap_path_to_url(func, *, extensions):
+def wrap_path_to_url(func, *, extensions, prefers_original):
     """Wrap mkdocs.structure.pages._RelativePathTreeprocessor.path_to_url logic to swap in WebP paths"""
 
     if func.__name__ == "wrapper":
@@ -233,14 +1319,16 @@ def wrap_path_to_url(func, *, extensions):
             scheme, netloc, path, query, anchor = urlsplit(url)
             # Hack the output to point at the converted file
             if not (scheme or netloc):
-                return func(self, url).rsplit(".", maxsplit=1)[0] + ".webp"
+                file = self.files.get_file_from_path(self._target_uri(self.file.src_uri, path))
+                if not prefers_original(file):
+                    return func(self, url).rsplit(".", maxsplit=1)[0] + ".webp"
 
         return func(self, url)
 
     return wrapper
 
 
-def wrap_url_filter(func, *, extensions):
+def wrap_url_filter(func, *, extensions, get_original, prefers_original):
     """Wrap mkdocs.utils.templates.url_filter logic to swap in WebP paths"""
 
     if func.__name__ == "wrapper":
@@ -248,12 +1336,13 @@ def wrap_url_filter(func, *, extensions):
 
     extensions = tuple(extensions)
 
+    # The value is relative to the site_dir, so the original is found by its dest path
     @contextfilter
     def wrapper(context: templates.TemplateContext, value: str):
         if value and value.endswith(extensions):
             scheme, netloc, path, query, anchor = urlsplit(value)
             # Hack the output to point at the converted file
-            if not (scheme or netloc):
+            if not (scheme or netloc) and not prefers_original(get_original(path.lstrip("/"))):
                 return func(context, value).rsplit(".", maxsplit=1)[0] + ".webp"
 
         return func(context, value)
@@ -261,7 +1350,7 @@ def wrap_url_filter(func, *, extensions):
     return wrapper
 
 
-def wrap_run(func, *, extensions):
+def wrap_run(func, *, extensions, get_size, is_converted, get_config):
     """Wrap mkdocs.structure.pages._RelativePathTreeprocessor.run logic to swap in WebP paths"""
 
     if func.__name__ == "wrapper":
@@ -273,10 +1362,18 @@ def wrap_run(func, *, extensions):
     # The old image url is relative as input in the docs file, so it has to be resolved with
     # the private `_target_uri` method.
     # TODO At this point the files are guaranteed to exist in Files, because they're not removed.
-    # Read note in `on_files`. In case of removal the `_convert_image` function could also extract
-    # the sizes, instead of doing it here. However, doing it here is also performant, because the
-    # sizes are read from metadata headers.
+    # Read note in `on_files`. The sizes are extracted by `convert_image` and kept in the cache
+    # index, so `get_size` only opens an image if its source changed since the last build.
     def wrapper(self: pages._RelativePathTreeprocessor, root: etree.Element):
+        config: WebpImagesConfig = get_config()
+        add_sizes, widths, srcset_sizes = config.add_sizes, config.widths, config.srcset_sizes
+        avif: bool = config.avif
+
+        if not (add_sizes or widths or avif):
+            return func(self, root)
+
+        converted: list[tuple[etree.Element, int, list[int]]] = []
+
         for element in root.iter():
             if element.tag == "img":
                 key = "src"
@@ -295,15 +1392,63 @@ def wrap_run(func, *, extensions):
 
             file = self.files.get_file_from_path(self._target_uri(self.file.src_uri, path))
 
-            with Image.open(file.abs_src_path) as image:
-                element.set("height", str(image.height))
-                element.set("width", str(image.width))
+            width, height = get_size(file)
+            if add_sizes:
+                element.set("height", str(height))
+                element.set("width", str(width))
 
-        return func(self, root)
+            if is_converted(file):
+                converted.append((element, width, get_variant_widths(widths, width)))
+
+        result = func(self, root)
+
+        if not converted:
+            return result
+
+        # Picture elements replace the img in its parent, which etree doesn't track
+        parents = {child: parent for parent in root.iter() for child in parent} if avif else {}
+
+        # The src points at the WebP file now, so derive the other output urls from it
+        for element, width, variant_widths in converted:
+            base = element.get("src").rsplit(".", maxsplit=1)[0]
+
+            if variant_widths:
+                element.set("srcset", get_srcset(base, "webp", width, variant_widths))
+                element.set("sizes", srcset_sizes)
+
+            if not avif:
+                continue
+
+            picture = etree.Element("picture")
+            source = etree.SubElement(picture, "source", type="image/avif")
+            source.set("srcset", get_srcset(base, "avif", width, variant_widths))
+            if variant_widths:
+                source.set("sizes", srcset_sizes)
+
+            parent = parents[element]
+            index = list(parent).index(element)
+            parent.remove(element)
+            parent.insert(index, picture)
+            picture.tail, element.tail = element.tail, None
+            picture.append(element)
+
+        return result
 
     return wrapper
 
 
+def get_srcset(base: str, fmt: str, width: int, variant_widths: list[int]) -> str:
+    """Build the srcset value from the url without the extension"""
+
+    if not variant_widths:
+        return f"{base}.{fmt}"
+
+    candidates = [f"{base}{get_output_suffix(fmt, w)} {w}w" for w in variant_widths]
+    candidates.append(f"{base}.{fmt} {width}w")
+
+    return ", ".join(candidates)
+
+
 PLUGIN_NAME: str = "webp_images"
 """Name of the plugin"""
 